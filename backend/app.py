@@ -7,7 +7,11 @@
 # runserver.py
 #-----------------------------------------------------------------------
 
-import os, dotenv
+import time
+# worker startup is timed from the first line the worker runs
+_BOOT_START = time.perf_counter()
+
+import os, dotenv, threading
 dotenv.load_dotenv()
 
 #-----------------------------------------------------------------------
@@ -15,10 +19,14 @@ dotenv.load_dotenv()
 from flask import Flask
 from flask_cors import CORS
 from routes import main, auth_bp, community
+import database
+import metrics
+import uploads
 
 #-----------------------------------------------------------------------
 
 def create_app():
+    start = time.perf_counter()
     app = Flask(__name__)
     # TODO needs dynamic adjustment
     CORS(app, origins=["http://localhost:3003"])
@@ -30,10 +38,20 @@ def create_app():
     app.register_blueprint(main)
     app.register_blueprint(auth_bp)
     app.register_blueprint(community)
+    app.teardown_appcontext(database.close_session)
+    metrics.init_app(app)
+
+    # pick up image uploads interrupted by a restart, without holding up
+    # the worker on the database
+    threading.Thread(target=uploads.resume, daemon=True,
+                     name='resume-uploads').start()
 
+    metrics.record_startup('create_app', time.perf_counter() - start)
     return app
     
 app = create_app()
+metrics.record_startup('boot', time.perf_counter() - _BOOT_START)
+print(f'Worker started in {metrics.startup["boot"] * 1000:.0f} ms.')
     
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5010, debug=True)
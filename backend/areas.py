@@ -0,0 +1,66 @@
+"""
+Matches marker locations to the geographic areas containing them with
+an in-memory STRtree of area outlines. The tree is rebuilt whenever the
+areas table changes, including changes made by other workers.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# areas.py
+#-----------------------------------------------------------------------
+
+import threading
+from shapely import STRtree
+from geoalchemy2.shape import to_shape
+from sqlalchemy import func
+from models import GeoAreas
+
+#-----------------------------------------------------------------------
+
+class AreaIndex:
+    """STRtree of GeoAreas outlines keyed by area id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._tree = None
+        self._ids = []
+
+    def _load(self, session):
+        # a cheap fingerprint of the areas table decides whether to reload
+        version = tuple(session.query(
+            func.count(GeoAreas.id), func.max(GeoAreas.id), func.max(GeoAreas.updated)
+        ).one())
+        with self._lock:
+            if version == self._version:
+                return self._tree, self._ids
+
+        rows = session.query(GeoAreas.id, GeoAreas.geom).all()
+        ids = [id for id, _ in rows]
+        tree = STRtree([to_shape(geom) for _, geom in rows]) if rows else None
+        with self._lock:
+            self._version, self._tree, self._ids = version, tree, ids
+        return tree, ids
+
+    def match(self, session, points):
+        """
+        Gets the ids of the areas intersecting each shapely point in
+        points, as one list per point.
+        """
+        matches = [[] for _ in points]
+        tree, ids = self._load(session)
+        if tree is None or not points:
+            return matches
+        point_indices, area_indices = tree.query(points, predicate='intersects')
+        for point_index, area_index in zip(point_indices, area_indices):
+            matches[point_index].append(ids[area_index])
+        return matches
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+#-----------------------------------------------------------------------
+
+index = AreaIndex()
@@ -0,0 +1 @@
+"""Benchmarks for the Flask endpoints and database layer."""
@@ -0,0 +1,135 @@
+"""
+Generates seeded synthetic users, communities, cameras, sightings, and
+areas across Los Angeles for benchmarking. Meant for a local PostGIS
+database only: reset() empties every table.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# generate.py
+#-----------------------------------------------------------------------
+
+import random
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import insert, text
+from shapely.geometry import Point
+from models import Base, Session, Users, Cameras, Sightings, GeoAreas, Communities
+from models import UserCommunities, CameraCommunities, SightingCommunities, GeoAreaCommunities
+from database import rebuild_areas
+
+#-----------------------------------------------------------------------
+
+# west, south, east, north
+LA_BBOX = (-118.95, 33.70, -117.65, 34.35)
+SPECIES = ['Coyote', 'Bobcat', 'Mountain Lion', 'Mule Deer', 'Gray Fox',
+           'Raccoon', 'Striped Skunk', 'Virginia Opossum', 'Black Bear',
+           'Western Gray Squirrel']
+OBSERVERS = [f'Observer {i}' for i in range(25)]
+BATCH_SIZE = 5000
+
+# dataset sizes; the benchmark user belongs to a third of the communities
+SIZES = {
+    "small": dict(users=20, communities=6, cameras=200, sightings=2000, areas=20),
+    "medium": dict(users=100, communities=15, cameras=2000, sightings=20000, areas=100),
+    "large": dict(users=500, communities=30, cameras=10000, sightings=100000, areas=300),
+}
+BENCH_UID = 'bench-user-0'
+
+#-----------------------------------------------------------------------
+
+def _point(rng):
+    west, south, east, north = LA_BBOX
+    return rng.uniform(west, east), rng.uniform(south, north)
+
+def _ewkt(geom):
+    return f'SRID=4326;{geom.wkt}'
+
+def _date(rng, start):
+    return start + timedelta(seconds=rng.randrange(2 * 365 * 24 * 3600),
+                             microseconds=rng.randrange(1000000))
+
+def _insert(session, model, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        session.execute(insert(model), rows[start:start + BATCH_SIZE])
+
+def reset():
+    """Empties every table. Never point this at a real database."""
+    with Session() as session:
+        tables = ', '.join(table.name for table in Base.metadata.sorted_tables)
+        session.execute(text(f'TRUNCATE {tables} RESTART IDENTITY CASCADE'))
+        session.commit()
+
+def seed(users, communities, cameras, sightings, areas, seed=0):
+    """
+    Inserts the given numbers of synthetic rows, reproducibly for a
+    given seed. Returns the ids of the inserted cameras.
+    """
+    rng = random.Random(seed)
+    start = datetime.now(timezone.utc) - timedelta(days=2 * 365)
+    codes = [f'BENCH{i:07d}' for i in range(communities)]
+
+    with Session() as session:
+        _insert(session, Users, [
+            {"uid": f'bench-user-{i}', "name": f'User {i}',
+             "email": f'user{i}@bench.test'}
+            for i in range(users)
+        ])
+        _insert(session, Communities, [
+            {"code": code, "owner": 'User 0', "name": f'Community {i}',
+             "description": 'Benchmark community', "imageUrl": ''}
+            for i, code in enumerate(codes)
+        ])
+
+        memberships = {(BENCH_UID, code) for code in codes[::3]}
+        for i in range(1, users):
+            for code in rng.sample(codes, min(len(codes), rng.randint(1, 3))):
+                memberships.add((f'bench-user-{i}', code))
+        _insert(session, UserCommunities, [
+            {"uid": uid, "code": code} for uid, code in sorted(memberships)
+        ])
+
+        camera_rows = []
+        for i in range(cameras):
+            days = rng.randint(1, 30)
+            camera_rows.append({
+                "owner": 'User 0', "site": f'Site {i % 50}',
+                "crds": _ewkt(Point(*_point(rng))),
+                "status": f'pull,{days}', "date": _date(rng, start),
+                "camera_id": f'CAM{i:06d}', "type": 'Browning', "perc": 100,
+                "mem": '32GB', "lock": None, "comments": None
+            })
+        _insert(session, Cameras, camera_rows)
+
+        sighting_rows = [{
+            "title": f'Sighting {i}', "owner": 'User 0',
+            "observer": rng.choice(OBSERVERS),
+            "crds": _ewkt(Point(*_point(rng))), "date": _date(rng, start),
+            "species": rng.choice(SPECIES), "number": rng.randint(1, 4),
+            "type": 'Camera Trap', "url": '', "comments": None
+        } for i in range(sightings)]
+        _insert(session, Sightings, sighting_rows)
+
+        area_rows = []
+        for i in range(areas):
+            radius = rng.uniform(0.005, 0.05)
+            area_rows.append({
+                "name": f'Area {i}', "description": 'Benchmark area',
+                "geom": _ewkt(Point(*_point(rng)).buffer(radius, quad_segs=16))
+            })
+        _insert(session, GeoAreas, area_rows)
+
+        # ids are sequential after reset()
+        for model, link, count in ((Cameras, CameraCommunities, cameras),
+                                   (Sightings, SightingCommunities, sightings),
+                                   (GeoAreas, GeoAreaCommunities, areas)):
+            links = set()
+            for id in range(1, count + 1):
+                for code in rng.sample(codes, min(len(codes), rng.randint(1, 2))):
+                    links.add((id, code))
+            _insert(session, link, [{"id": id, "code": code} for id, code in sorted(links)])
+
+        session.commit()
+
+    rebuild_areas()
+    return list(range(1, cameras + 1))
@@ -0,0 +1,177 @@
+"""
+Times the marker reads, add_camera, and the /get-markers route at
+several synthetic dataset sizes, and saves the results as JSON so runs
+can be compared between commits.
+
+Run from backend/ against a local PostGIS database, which is emptied:
+
+    python -m benchmarks.run --reset --sizes small medium
+    python -m benchmarks.run --compare results/a.json results/b.json
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# run.py
+#-----------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+#-----------------------------------------------------------------------
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+class CallFailed(Exception):
+    """A timed call reported an error instead of returning its result."""
+
+def _check(result):
+    """
+    Raises CallFailed if result, a database function's return value or
+    a test client response, reports a failure. Both answer errors with
+    success set to false, the routes with HTTP 200.
+    """
+    if hasattr(result, 'get_json'):
+        if result.status_code != 200:
+            raise CallFailed(f'HTTP {result.status_code}')
+        result = result.get_json()
+    if isinstance(result, dict) and result.get("success") is False:
+        raise CallFailed(result.get("message", 'unknown error'))
+
+def _time(fn, repeat):
+    """
+    Runs fn repeat times and summarizes the wall-clock durations. Raises
+    CallFailed if any call fails, so errors are not timed as results.
+    """
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn(i)
+        durations.append(time.perf_counter() - start)
+        _check(result)
+    durations.sort()
+    return {
+        "min": durations[0],
+        "median": statistics.median(durations),
+        "p95": durations[min(len(durations) - 1, int(0.95 * len(durations)))],
+        "mean": statistics.fmean(durations)
+    }
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       text=True).strip()
+    except Exception:
+        return 'unknown'
+
+#-----------------------------------------------------------------------
+
+def run(sizes, repeat, seed):
+    # imported here so --compare works without a database
+    import cache
+    import database
+    import manage
+    from app import create_app
+    from benchmarks import generate
+
+    manage.init_db()
+
+    # measure cold reads: nothing is kept in the marker cache
+    cache.set_backend(cache.LRUCache(maxsize=0))
+    app = create_app()
+    app.config["TESTING_BYPASS_AUTH"] = True
+    client = app.test_client()
+    uid = generate.BENCH_UID
+
+    results = {"commit": _commit(),
+               "date": datetime.now(timezone.utc).isoformat(),
+               "repeat": repeat, "seed": seed, "sizes": {}}
+
+    for size in sizes:
+        counts = generate.SIZES[size]
+        print(f'Seeding {size} dataset: {counts}')
+        generate.reset()
+        generate.seed(seed=seed, **counts)
+
+        def add_camera(i):
+            return database.add_camera({
+                "uid": uid, "site": 'Bench', "lat": 34.1, "lon": -118.2,
+                "datetime": datetime.now(timezone.utc).isoformat(),
+                "next": 'pull', "daysAhead": '7', "camera_id": f'BENCH{i}',
+                "type": 'Browning', "perc": 100, "mem": '32GB', "lock": None,
+                "comment": None, "communities": 'BENCH0000000'
+            })
+
+        try:
+            timings = {
+                "get_cameras": _time(lambda i: database.get_cameras(uid), repeat),
+                "get_sightings": _time(lambda i: database.get_sightings(uid), repeat),
+                "get_areas": _time(lambda i: database.get_areas(uid), repeat),
+                "add_camera": _time(add_camera, repeat),
+                "/get-markers": _time(
+                    lambda i: client.post('/get-markers', data={"uid": uid}), repeat
+                ),
+            }
+        except CallFailed as e:
+            print(f'  Skipping {size}: a timed call failed: {e}')
+            continue
+        results["sizes"][size] = {"counts": counts, "timings": timings}
+        for name, timing in timings.items():
+            print(f'  {name:15} median {timing["median"] * 1000:9.1f} ms'
+                  f'   p95 {timing["p95"] * 1000:9.1f} ms')
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f'{results["commit"]}-{int(time.time())}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved to {path}')
+    return path
+
+def compare(before, after):
+    """Prints the median timing ratios of two saved runs."""
+    with open(before) as f:
+        old = json.load(f)
+    with open(after) as f:
+        new = json.load(f)
+
+    print(f'{old["commit"]} -> {new["commit"]}')
+    for size, result in new["sizes"].items():
+        if size not in old["sizes"]:
+            continue
+        print(size)
+        for name, timing in result["timings"].items():
+            previous = old["sizes"][size]["timings"].get(name)
+            if previous:
+                ratio = timing["median"] / previous["median"]
+                print(f'  {name:15} {previous["median"] * 1000:9.1f} ms'
+                      f' -> {timing["median"] * 1000:9.1f} ms  ({ratio:.2f}x)')
+
+#-----------------------------------------------------------------------
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--sizes', nargs='+', default=['small'],
+                            choices=['small', 'medium', 'large'])
+    arg_parser.add_argument('--repeat', type=int, default=10)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--reset', action='store_true',
+                            help='confirm that the database may be emptied')
+    arg_parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = arg_parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.reset:
+        sys.exit('Benchmarks empty the database; pass --reset to confirm.')
+    run(args.sizes, args.repeat, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Caches marker responses keyed by community set. Entries are tagged
+with the communities they depend on so writes can invalidate only the
+affected entries.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# cache.py
+#-----------------------------------------------------------------------
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+#-----------------------------------------------------------------------
+
+class LRUCache:
+    """In-process least recently used cache with a time to live."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value, _ = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            self._remove(key)
+            tags = frozenset(tags)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def _remove(self, key):
+        """Drops key and its place in the tag sets. Hold the lock."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+#-----------------------------------------------------------------------
+
+class RedisCache:
+    """
+    Cache stored in Redis, or any client implementing the same get, set,
+    sadd, smembers, expire and delete commands.
+    """
+
+    def __init__(self, client, ttl=60, prefix='afc:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, tags=()):
+        key = self.prefix + key
+        self.client.set(key, json.dumps(value), ex=self.ttl)
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            self.client.sadd(tag_key, key)
+            self.client.expire(tag_key, self.ttl)
+
+    def invalidate(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = self.client.smembers(tag_key)
+            self.client.delete(tag_key, *keys)
+
+#-----------------------------------------------------------------------
+
+class MarkerCache:
+    """Counts hits and misses in front of a swappable cache backend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, tags=()):
+        self.backend.set(key, value, tags)
+
+    def invalidate(self, tags):
+        self.backend.invalidate(list(tags))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / total if total else 0.0
+        }
+
+#-----------------------------------------------------------------------
+
+def create_backend():
+    """
+    Creates the backend named by MARKER_CACHE_URL: a redis:// URL, or
+    the in-process LRU cache if unset.
+    """
+    ttl = int(os.environ.get('MARKER_CACHE_TTL', 60))
+    url = os.environ.get('MARKER_CACHE_URL')
+    if url:
+        import redis
+        return RedisCache(redis.Redis.from_url(url), ttl=ttl)
+    return LRUCache(int(os.environ.get('MARKER_CACHE_SIZE', 1024)), ttl=ttl)
+
+markers = MarkerCache(create_backend())
+
+def set_backend(backend):
+    """Replaces the marker cache backend, e.g. with a local stand-in."""
+    markers.backend = backend
@@ -6,26 +6,92 @@
 # database.py
 #-----------------------------------------------------------------------
 
-# cloudinary configuration
-import cloudinary
-import cloudinary.uploader
-
-#-----------------------------------------------------------------------
-
+import os
 import string
 import json
+import hashlib
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import sqlalchemy.event, sqlalchemy.pool
+from sqlalchemy import select, func, extract, text, or_, exists, tuple_, literal
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert
 from geoalchemy2.shape import from_shape, to_shape
-from geoalchemy2.functions import ST_Intersects
+from geoalchemy2.functions import ST_Intersects, ST_MakeEnvelope
+from geoalchemy2.functions import ST_SimplifyPreserveTopology
+from geoalchemy2.functions import ST_DWithin, ST_Distance, ST_MakePoint, ST_SetSRID, ST_X, ST_Y
 from shapely.geometry import Point, mapping
+from contextlib import contextmanager
 from dateutil import parser
+from flask import g, has_app_context
 from models import Session, Users, Cameras, Sightings, GeoAreas, Communities
 from models import UserCommunities, CameraCommunities, SightingCommunities, GeoAreaCommunities
+from models import CommunityDepartures, UploadJobs, GeoAreaLevels
+from models import GeoAreaCameras, GeoAreaSightings
+import areas
+import cache
+import events
+import exif
+import metrics
+import serializers
+import uploads
+
+#-----------------------------------------------------------------------
+
+# sync cursors trail the clock so rows committed by transactions still in
+# flight when the cursor was issued are picked up by the next sync
+CURSOR_LAG = timedelta(seconds=30)
+# rows fetched per round trip when streaming markers
+YIELD_PER = 500
+# rows sent per statement by bulk inserts
+INSERT_BATCH_SIZE = 1000
+LOCAL_TIMEZONE = ZoneInfo('America/Los_Angeles')
+STATUS_PATTERN = re.compile(r'^\s*(\w+)\s*,\s*(\d+)\s*$')
+# /get-markers runs its reads on this many threads; 0 runs them in turn
+READ_WORKERS = int(os.environ.get('MARKER_READ_WORKERS', 8))
+# counted from when each read starts, not while it waits for a thread
+READ_TIMEOUT = float(os.environ.get('MARKER_READ_TIMEOUT', 30))
+READ_POLL = 0.5
+# zoom levels with a stored simplified area outline; closer zooms are
+# sent the full outline
+AREA_LEVELS = (4, 8, 11, 14)
+# advisory lock key serializing writes to the area membership tables
+MEMBERSHIP_LOCK = 0x61666301
 
 #-----------------------------------------------------------------------
 
 """Helper Functions."""
 
+@contextmanager
+def _session():
+    """
+    Yields the session shared by all database calls in the current 
+    request, or a new session outside of a request. Failed calls roll 
+    the session back so later calls can keep using it.
+    """
+    if not has_app_context():
+        with Session() as session:
+            yield session
+        return
+
+    if 'db_session' not in g:
+        g.db_session = Session()
+    try:
+        yield g.db_session
+    except Exception:
+        g.db_session.rollback()
+        raise
+
+def close_session(exception=None):
+    """Closes the request's shared session, if one was opened."""
+    session = g.pop('db_session', None)
+    if session is not None:
+        session.close()
+
 def to_dict(instance, exclude=None):
     exclude = exclude or []
     result = {}
@@ -41,13 +107,146 @@ def to_dict(instance, exclude=None):
             point = to_shape(value)
             # output lat, lon as string for consistency
             value = f"{point.y}, {point.x}"
-        elif c.name in ("date", "date_placed") and value is not None:
+        elif c.name in ("date", "date_placed", "created", "updated") and value is not None:
             value = value.isoformat()
 
         result[c.name] = value
 
     return result
 
+def _visible_ids(link, codes):
+    """Selects the ids in the join table link shared with any of codes."""
+    return select(link.id).where(link.code.in_(codes))
+
+def _visible(model, link, codes):
+    """True for markers of model shared with any of codes."""
+    return exists().where(link.id == model.id, link.code.in_(codes))
+
+def _communities(model, link, codes):
+    """Selects the codes, among codes, each marker of model is shared with."""
+    return select(
+        func.array_agg(link.code)
+    ).where(
+        link.id == model.id, link.code.in_(codes)
+    ).scalar_subquery().label("communities")
+
+def _joined_since(uid, since):
+    """Selects the codes of communities the user joined after since."""
+    return select(UserCommunities.code).where(
+        UserCommunities.uid == uid, UserCommunities.joined > since
+    )
+
+def _memberships_changed(uid, since):
+    """True if the user joined or left a community after since."""
+    return or_(
+        exists().where(UserCommunities.uid == uid, UserCommunities.joined > since),
+        exists().where(CommunityDepartures.uid == uid, CommunityDepartures.date > since)
+    )
+
+def _sighting_filters(filters):
+    """
+    Builds the conditions for sighting filters: a start and end time, 
+    and lists of species and observers.
+    """
+    filters = filters or {}
+    conditions = []
+    if filters.get("start"):
+        conditions.append(Sightings.date >= filters["start"])
+    if filters.get("end"):
+        conditions.append(Sightings.date < filters["end"])
+    if filters.get("species"):
+        conditions.append(Sightings.species.in_(filters["species"]))
+    if filters.get("observer"):
+        conditions.append(Sightings.observer.in_(filters["observer"]))
+    return conditions
+
+def _envelope(bbox):
+    """Builds a WGS84 envelope from a (west, south, east, north) box."""
+    west, south, east, north = bbox
+    return ST_MakeEnvelope(west, south, east, north, 4326)
+
+def _tolerance(zoom):
+    """Approximates the width of one map pixel, in degrees, at zoom."""
+    return 360.0 / (256 * 2 ** zoom)
+
+def _area_level(zoom):
+    """Gets the coarsest stored outline level detailed enough for zoom."""
+    for level in AREA_LEVELS:
+        if zoom <= level:
+            return level
+    return None
+
+def _store_levels(session, area_ids):
+    """Stores the simplified outlines of the given areas at every level."""
+    for level in AREA_LEVELS:
+        statement = insert(GeoAreaLevels).from_select(
+            ["id", "level", "geom"],
+            select(
+                GeoAreas.id, literal(level),
+                ST_SimplifyPreserveTopology(GeoAreas.geom, _tolerance(level))
+            ).where(GeoAreas.id.in_(area_ids))
+        )
+        session.execute(statement.on_conflict_do_update(
+            index_elements=["id", "level"],
+            set_={"geom": statement.excluded.geom}
+        ))
+
+def _lock_membership(session):
+    """
+    Holds the membership lock until the session's transaction ends, so
+    an area and a marker committed concurrently each see the other once
+    the lock is taken, instead of both missing the pair.
+    """
+    session.execute(text("SELECT pg_advisory_xact_lock(:key)"),
+                    {"key": MEMBERSHIP_LOCK})
+
+def _store_members(session, link, markers):
+    """
+    Records which areas contain each new marker, given as (id, shapely 
+    point) pairs, in the area membership table link.
+    """
+    _lock_membership(session)
+    ids = [id for id, _ in markers]
+    matches = areas.index.match(session, [point for _, point in markers])
+    rows = [{"area": area, "id": id} for id, found in zip(ids, matches) for area in found]
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        session.execute(insert(link), rows[start:start + INSERT_BATCH_SIZE])
+
+def _store_area_members(session, area_ids):
+    """Records the markers inside the given areas with one spatial join each."""
+    _lock_membership(session)
+    for model, link in ((Cameras, GeoAreaCameras), (Sightings, GeoAreaSightings)):
+        session.execute(insert(link).from_select(
+            ["area", "id"],
+            select(GeoAreas.id, model.id).join(
+                model, ST_Intersects(model.crds, GeoAreas.geom)
+            ).where(GeoAreas.id.in_(area_ids))
+        ).on_conflict_do_nothing())
+
+def _publish(session, model, link, kind, ids, action):
+    """
+    Publishes the given markers of model to the members of every
+    community they are shared with, once the session commits.
+    """
+    communities = select(
+        func.array_agg(link.code)
+    ).where(link.id == model.id).scalar_subquery().label("communities")
+    rows = session.query(*serializers.columns(model), communities).filter(
+        model.id.in_(ids)
+    )
+    for row in rows:
+        marker = serializers.to_dict(row)
+        events.publish(session, {"type": kind, "action": action, "marker": marker,
+                                 "communities": marker["communities"]})
+
+def _empty_stats():
+    return {
+        "numSightings": 0,
+        "speciesDist": {},
+        "observerDist": {},
+        "hourBins": [0] * 24
+    }
+
 def gen_join_code(length):
     characters = string.ascii_letters + string.digits
     return ''.join(secrets.choice(characters) for _ in range(length))
@@ -56,104 +255,221 @@ def gen_join_code(length):
 
 """Read operations for the database."""
 
+#-----------------------------------------------------------------------
+
+def _marker_query(session, model, link, uid, bbox=None, since=None, after=None,
+                  conditions=()):
+    """
+    Queries the markers of model visible to the given user through the
+    join table link, optionally limited to the bounding box bbox, to 
+    markers that changed or became visible after since, to ids after 
+    the keyset cursor after, and to any further conditions. Each marker
+    is returned once, with the user's communities it is shared with, 
+    ordered by id.
+    """
+    codes = get_community_codes(uid)
+    query = session.query(
+        *serializers.columns(model), _communities(model, link, codes)
+    ).filter(_visible(model, link, codes))
+
+    if bbox:
+        query = query.filter(ST_Intersects(model.crds, _envelope(bbox)))
+    if since:
+        query = query.filter(or_(
+            model.updated > since,
+            _visible(model, link, _joined_since(uid, since))
+        ))
+    if after is not None:
+        query = query.filter(model.id > after)
+    if conditions:
+        query = query.filter(*conditions)
+
+    return query.order_by(model.id)
+
+def _iter_markers(model, link, uid, bbox=None, after=None, conditions=()):
+    """
+    Yields the markers of model visible to the given user one at a time,
+    fetching them through a server-side cursor.
+    """
+    with _session() as session:
+        query = _marker_query(session, model, link, uid, bbox, after=after,
+                              conditions=conditions)
+        for marker in query.execution_options(yield_per=YIELD_PER):
+            yield serializers.to_dict(marker)
+
+def _read_markers(query, columnar=False):
+    """Serializes the rows of a marker query as dicts or as columns."""
+    if columnar:
+        keys = [column["name"] for column in query.column_descriptions]
+        return serializers.to_columnar(query.all(), keys)
+    return [serializers.to_dict(row) for row in query.all()]
+
 #-----------------------------------------------------------------------
 # Section: Camera Traps
 #-----------------------------------------------------------------------
 
-def get_cameras(uid):
-    """Gets all cameras that the given user has access to."""
+def get_cameras(uid, bbox=None, since=None, after=None, limit=None,
+                columnar=False):
+    """
+    Gets all cameras that the given user has access to, optionally 
+    limited to the bounding box bbox and to cameras that changed or 
+    became visible after since. If limit is given, returns one page of 
+    at most limit cameras with ids greater than after. If columnar is
+    set, cameras are returned as parallel arrays of their fields.
+    """
     try:
-        with Session() as session:
-            query = session.query(Cameras).join(
-                CameraCommunities, Cameras.id == CameraCommunities.id
-            ).join(
-                UserCommunities, UserCommunities.code == CameraCommunities.code
-            ).filter(UserCommunities.uid == uid)
+        with _session() as session:
+            query = _marker_query(session, Cameras, CameraCommunities,
+                                  uid, bbox, since, after)
+            if limit:
+                query = query.limit(limit)
 
-            data = query.all()
-            cameras = [to_dict(camera) for camera in data]
-            return cameras
+            return _read_markers(query, columnar)
     except Exception as e:
         return {"success": False, "message": str(e)}
     
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+def iter_cameras(uid, bbox=None, after=None):
+    """Streams all cameras that the given user has access to."""
+    return _iter_markers(Cameras, CameraCommunities, uid, bbox, after)
+
 #-----------------------------------------------------------------------
 # Section: Wildlife Sightings
 #-----------------------------------------------------------------------
 
-def get_sightings(uid):
-    """Gets all wildlife sightings that the given user has access to."""
+def get_sightings(uid, bbox=None, since=None, after=None, limit=None,
+                  columnar=False, filters=None):
+    """
+    Gets all wildlife sightings that the given user has access to, 
+    optionally limited to the bounding box bbox, to sightings that 
+    changed or became visible after since, and by the time, species, 
+    and observer filters. If limit is given, returns one page of at 
+    most limit sightings with ids greater than after. If columnar is 
+    set, sightings are returned as parallel arrays of their fields.
+    """
     try:
-        with Session() as session:
-            query = session.query(Sightings).join(
-                SightingCommunities, Sightings.id == SightingCommunities.id
-            ).join(
-                UserCommunities, UserCommunities.code == SightingCommunities.code
-            ).filter(UserCommunities.uid == uid)
+        with _session() as session:
+            query = _marker_query(session, Sightings, SightingCommunities,
+                                  uid, bbox, since, after,
+                                  _sighting_filters(filters))
+            if limit:
+                query = query.limit(limit)
 
-            data = query.all()
-            sightings = [to_dict(sighting) for sighting in data]
-            return sightings
+            return _read_markers(query, columnar)
     except Exception as e:
         return {"success": False, "message": str(e)}
     
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+def iter_sightings(uid, bbox=None, after=None, filters=None):
+    """Streams all wildlife sightings that the given user has access to."""
+    return _iter_markers(Sightings, SightingCommunities, uid, bbox, after,
+                         _sighting_filters(filters))
+
 #-----------------------------------------------------------------------
 # Section: Geographic Areas
 #-----------------------------------------------------------------------
 
-def get_areas(uid):
-    """Gets all geographic areas available to the current user."""
+def get_areas(uid, bbox=None, zoom=None, since=None, filters=None):
+    """
+    Gets all geographic areas available to the current user, optionally
+    limited to those intersecting the bounding box bbox. If zoom is 
+    given, area outlines are sent at the stored level of detail for 
+    that zoom. If since is given, only areas whose outline or stats 
+    may have changed after since are returned. Sighting stats only 
+    count sightings matching the sighting filters.
+    """
     try:
-        with Session() as session:
-            query = session.query(GeoAreas).join(
-                GeoAreaCommunities, GeoAreas.id == GeoAreaCommunities.id
-            ).join(
-                UserCommunities, UserCommunities.code == GeoAreaCommunities.code
-            ).filter(UserCommunities.uid == uid)
-            
-            areas = query.all()
-            
-            results = []
-            for area in areas:
-                geom = mapping(to_shape(area.geom))
-                
-                cameras = session.query(Cameras).filter(
-                    ST_Intersects(Cameras.crds, area.geom)
-                ).all()
-                
-                sightings = session.query(Sightings).filter(
-                    ST_Intersects(Sightings.crds, area.geom)
-                ).all()
+        with _session() as session:
+            codes = get_community_codes(uid)
+
+            level = _area_level(zoom) if zoom is not None else None
+            geom = GeoAreas.geom
+            if level is not None:
+                # areas without stored outlines fall back to the full one
+                geom = func.coalesce(GeoAreaLevels.geom, GeoAreas.geom)
 
-                species_counter = {}
-                observer_counter = {}
-                hour_bins = [0] * 24
+            query = session.query(
+                GeoAreas.id, GeoAreas.name, GeoAreas.description, geom,
+                _communities(GeoAreas, GeoAreaCommunities, codes)
+            ).filter(_visible(GeoAreas, GeoAreaCommunities, codes))
 
-                for sighting in sightings:
-                    species = sighting.species
-                    species_counter[species] = species_counter.get(species, 0) + 1
+            if level is not None:
+                query = query.outerjoin(GeoAreaLevels, (
+                    (GeoAreaLevels.id == GeoAreas.id) & (GeoAreaLevels.level == level)
+                ))
 
-                    observer = sighting.observer
-                    observer_counter[observer] = observer_counter.get(observer, 0) + 1
+            if bbox:
+                query = query.filter(ST_Intersects(GeoAreas.geom, _envelope(bbox)))
+            if since:
+                query = query.filter(or_(
+                    GeoAreas.updated > since,
+                    _memberships_changed(uid, since),
+                    exists().where(
+                        GeoAreaCameras.area == GeoAreas.id,
+                        Cameras.id == GeoAreaCameras.id,
+                        Cameras.updated > since
+                    ),
+                    exists().where(
+                        GeoAreaSightings.area == GeoAreas.id,
+                        Sightings.id == GeoAreaSightings.id,
+                        Sightings.updated > since
+                    )
+                ))
 
-                    local_hour = local_hour = sighting.date.hour
-                    hour_bins[local_hour] += 1
+            areas = query.order_by(GeoAreas.id).all()
+            area_ids = [area.id for area in areas]
 
+            # membership is stored, so stats are indexed lookups
+            camera_counts = dict(session.query(
+                GeoAreaCameras.area, func.count(GeoAreaCameras.id)
+            ).filter(
+                GeoAreaCameras.area.in_(area_ids),
+                _visible(GeoAreaCameras, CameraCommunities, codes)
+            ).group_by(GeoAreaCameras.area).all())
+
+            hour = extract('hour', Sightings.date)
+            sighting_groups = session.query(
+                GeoAreaSightings.area, Sightings.species, Sightings.observer,
+                hour, func.count(Sightings.id)
+            ).join(
+                Sightings, Sightings.id == GeoAreaSightings.id
+            ).filter(
+                GeoAreaSightings.area.in_(area_ids),
+                _visible(Sightings, SightingCommunities, codes),
+                *_sighting_filters(filters)
+            ).group_by(
+                GeoAreaSightings.area, Sightings.species, Sightings.observer, hour
+            ).all()
+
+            stats = {}
+            for area_id, species, observer, local_hour, count in sighting_groups:
+                area_stats = stats.setdefault(area_id, _empty_stats())
+                area_stats["numSightings"] += count
+                species_counter = area_stats["speciesDist"]
+                species_counter[species] = species_counter.get(species, 0) + count
+                observer_counter = area_stats["observerDist"]
+                observer_counter[observer] = observer_counter.get(observer, 0) + count
+                area_stats["hourBins"][int(local_hour)] += count
+
+            results = []
+            for area_id, name, description, area_geom, communities in areas:
+                area_stats = stats.get(area_id) or _empty_stats()
                 results.append({
-                    "name": area.name,
-                    "description": area.description,
-                    "geom": geom,
-                    "numCameras": len(cameras),
-                    "numSightings": len(sightings),
-                    "numSpecies": len(species_counter),
-                    "speciesDist": species_counter,
-                    "observerDist": observer_counter,
-                    "hourBins": hour_bins
+                    "id": area_id,
+                    "name": name,
+                    "description": description,
+                    "geom": mapping(to_shape(area_geom)),
+                    "numCameras": camera_counts.get(area_id, 0),
+                    "numSightings": area_stats["numSightings"],
+                    "numSpecies": len(area_stats["speciesDist"]),
+                    "speciesDist": area_stats["speciesDist"],
+                    "observerDist": area_stats["observerDist"],
+                    "hourBins": area_stats["hourBins"],
+                    "communities": communities
                 })
                 
             return results
@@ -161,6 +477,412 @@ def get_areas(uid):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+#-----------------------------------------------------------------------
+# Section: Marker Sync
+#-----------------------------------------------------------------------
+
+def _cursor(session):
+    now = session.execute(select(func.now())).scalar()
+    return (now - CURSOR_LAG).isoformat()
+
+def get_cursor():
+    """Gets a cursor for the next incremental marker sync."""
+    with _session() as session:
+        return _cursor(session)
+
+def _oldest(*cursors):
+    return min(cursors, key=parser.isoparse)
+
+def get_marker_version(uid):
+    """
+    Gets a digest that changes whenever any marker visible to the given
+    user is added, changed, or removed, or their communities change.
+    """
+    key = f"version:{uid}"
+    version = cache.markers.get(key)
+    if version is None:
+        version = _get_marker_version(uid)
+        codes = get_community_codes(uid)
+        cache.markers.set(key, version, [f"user:{uid}", *codes])
+    return version
+
+def _get_marker_version(uid):
+    codes = get_community_codes(uid)
+    with _session() as session:
+        parts = []
+        for model, link in ((Cameras, CameraCommunities),
+                            (Sightings, SightingCommunities),
+                            (GeoAreas, GeoAreaCommunities)):
+            parts.append(select(
+                func.count(model.id), func.max(model.updated)
+            ).where(_visible(model, link, codes)))
+        parts.append(select(
+            func.count(UserCommunities.code), func.max(UserCommunities.joined)
+        ).where(UserCommunities.uid == uid))
+        parts.append(select(
+            func.count(CommunityDepartures.id), func.max(CommunityDepartures.date)
+        ).where(CommunityDepartures.uid == uid))
+
+        version = [tuple(session.execute(part).one()) for part in parts]
+        return hashlib.sha1(repr(version).encode()).hexdigest()
+
+_read_executor = ThreadPoolExecutor(
+    max_workers=READ_WORKERS, thread_name_prefix='marker-read'
+) if READ_WORKERS > 0 else None
+_read_local = threading.local()
+
+class _ReadGroup:
+    """
+    Tracks the connections in use by one request's concurrent reads so
+    their running queries can be cancelled together.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.cancelled = False
+        # when each read started, and the statements the reads ran
+        self.started = {}
+        self.queries = []
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def add(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+            cancelled = self.cancelled
+        if cancelled:
+            connection.cancel()
+
+    def discard(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            connections = list(self._connections)
+        for connection in connections:
+            # psycopg2 cancels the running query from any thread
+            connection.cancel()
+
+@sqlalchemy.event.listens_for(sqlalchemy.pool.Pool, 'checkout')
+def _track_checkout(dbapi_connection, record, proxy):
+    group = getattr(_read_local, 'group', None)
+    if group is not None:
+        group.add(dbapi_connection)
+
+@sqlalchemy.event.listens_for(sqlalchemy.pool.Pool, 'checkin')
+def _track_checkin(dbapi_connection, record):
+    # forget connections before the pool can hand them to another request
+    group = getattr(_read_local, 'group', None)
+    if group is not None and dbapi_connection is not None:
+        group.discard(dbapi_connection)
+
+def _run_read(group, name, read, args):
+    group.started[name] = time.monotonic()
+    _read_local.group = group
+    try:
+        with metrics.capture(group.route, group.queries):
+            return read(*args)
+    finally:
+        _read_local.group = None
+
+def _read_concurrently(reads):
+    """
+    Runs the independent reads, a dict of name to (function, args), on
+    separate threads and pooled connections, and gets their results by 
+    name. Reads report errors as dicts; if one fails or runs longer than
+    READ_TIMEOUT, the reads still pending or running are cancelled. The
+    reads' statements are added to the request's query breakdown.
+    """
+    if _read_executor is None:
+        return {name: read(*args) for name, (read, args) in reads.items()}
+
+    group = _ReadGroup(metrics.current_route())
+    futures = {_read_executor.submit(_run_read, group, name, read, args): name
+               for name, (read, args) in reads.items()}
+    results = {}
+    pending = set(futures)
+    while pending:
+        deadlines = [group.started[futures[future]] + READ_TIMEOUT
+                     for future in pending if futures[future] in group.started]
+        timeout = min(deadlines) - time.monotonic() if deadlines else READ_POLL
+        if timeout <= 0:
+            break
+        # reads waiting for a thread are polled until they start
+        done, pending = wait(pending, timeout=min(timeout, READ_POLL),
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+            results[futures[future]] = future.result()
+        if any(isinstance(results[futures[future]], dict)
+               and "success" in results[futures[future]] for future in done):
+            break
+
+    if has_app_context():
+        g.setdefault('sql_queries', []).extend(list(group.queries))
+    if len(results) < len(reads):
+        for future in futures:
+            future.cancel()
+        group.cancel()
+        for name in reads:
+            results.setdefault(name, {"success": False,
+                                      "message": f"Reading {name} was cancelled."})
+    return results
+
+def get_markers(uid, bbox=None, zoom=None, since=None, columnar=False,
+                filters=None):
+    """
+    Gets the cameras, sightings, and areas available to the given user,
+    reading the three concurrently, and the cursor for the next sync. 
+    Full reads depend only on the user's community set, so they are 
+    cached per community set until a write to one of those communities.
+    Cached reads and codes may predate writes made since, so the cursor
+    is the oldest of the ones taken before each of them was read.
+    """
+    reads = {
+        "cameras": (get_cameras, (uid, bbox, since, None, None, columnar)),
+        "sightings": (get_sightings, (uid, bbox, since, None, None, columnar,
+                                      filters)),
+        "areas": (get_areas, (uid, bbox, zoom, since, filters))
+    }
+    codes, codes_cursor = get_synced_codes(uid)
+    if since:
+        cursor = get_cursor()
+        return dict(_read_concurrently(reads), cursor=_oldest(codes_cursor, cursor))
+
+    key = f"markers:{','.join(codes)}:{bbox}:{zoom}:{columnar}:{sorted((filters or {}).items())}"
+    entry = cache.markers.get(key)
+    if entry is None:
+        cursor = get_cursor()
+        markers = _read_concurrently(reads)
+        # errors are reported as dicts and must not be cached
+        if not any(isinstance(value, dict) and "success" in value
+                   for value in markers.values()):
+            cache.markers.set(key, {"markers": markers, "cursor": cursor}, codes)
+    else:
+        markers, cursor = entry["markers"], entry["cursor"]
+    return dict(markers, cursor=_oldest(codes_cursor, cursor))
+
+def get_revoked(uid, since):
+    """
+    Gets the ids of markers the given user could see through a community
+    they left after since and can no longer see.
+    """
+    try:
+        codes = get_community_codes(uid)
+        with _session() as session:
+            departed = select(CommunityDepartures.code).where(
+                CommunityDepartures.uid == uid,
+                CommunityDepartures.date > since
+            )
+
+            revoked = {}
+            for name, link in (("cameras", CameraCommunities),
+                               ("sightings", SightingCommunities),
+                               ("areas", GeoAreaCommunities)):
+                ids = session.query(link.id).filter(
+                    link.code.in_(departed),
+                    link.id.not_in(_visible_ids(link, codes))
+                ).distinct().all()
+                revoked[name] = [id for id, in ids]
+            return revoked
+        
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+#-----------------------------------------------------------------------
+# Section: Analytics
+#-----------------------------------------------------------------------
+
+def get_activity(uid, area=None, community=None, filters=None):
+    """
+    Gets species by hour-of-day and species by day-of-week sighting 
+    counts, in local time, for the sightings the given user can see in 
+    the area with id area, or shared with the community community. Days
+    run from Sunday (0) to Saturday (6).
+    """
+    try:
+        codes = get_community_codes(uid)
+        if community is not None:
+            # only the user's own communities can be analyzed
+            codes = [code for code in codes if code == community]
+
+        with _session() as session:
+            local = func.timezone(LOCAL_TIMEZONE.key, Sightings.date)
+            hour = extract('hour', local)
+            day = extract('dow', local)
+            query = session.query(
+                Sightings.species, hour, day, func.count(Sightings.id)
+            ).filter(
+                _visible(Sightings, SightingCommunities, codes),
+                *_sighting_filters(filters)
+            )
+
+            if area is not None:
+                query = query.join(
+                    GeoAreaSightings, GeoAreaSightings.id == Sightings.id
+                ).filter(
+                    GeoAreaSightings.area == area,
+                    exists().where(GeoAreaCommunities.id == area,
+                                   GeoAreaCommunities.code.in_(codes))
+                )
+
+            groups = query.group_by(Sightings.species, hour, day).all()
+
+        # imported here to keep it out of worker startup
+        import numpy
+        species = sorted({group[0] for group in groups})
+        counts = numpy.zeros((len(species), 24, 7), dtype=numpy.int64)
+        if groups:
+            index = {name: i for i, name in enumerate(species)}
+            rows = numpy.array([index[group[0]] for group in groups])
+            hours = numpy.array([int(group[1]) for group in groups])
+            days = numpy.array([int(group[2]) for group in groups])
+            numpy.add.at(counts, (rows, hours, days),
+                         numpy.array([group[3] for group in groups]))
+
+        return {
+            "species": species,
+            "hourBins": counts.sum(axis=2).tolist(),
+            "dayBins": counts.sum(axis=1).tolist(),
+            "totals": counts.sum(axis=(1, 2)).tolist()
+        }
+
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+#-----------------------------------------------------------------------
+# Section: Nearby Search
+#-----------------------------------------------------------------------
+
+SEARCH_KINDS = {
+    "cameras": (Cameras, CameraCommunities),
+    "sightings": (Sightings, SightingCommunities),
+}
+
+def _search_origin(session, origin, codes):
+    """
+    Resolves a search origin, given as a (lat, lon) pair or as a (kind,
+    id) pair naming a marker visible through codes, to a geography point
+    and the marker to leave out of the results.
+    """
+    exclude = None
+    if origin[0] in SEARCH_KINDS:
+        model, link = SEARCH_KINDS[origin[0]]
+        marker = session.query(ST_Y(model.crds), ST_X(model.crds)).filter(
+            model.id == origin[1], _visible(model, link, codes)
+        ).one_or_none()
+        if marker is None:
+            raise ValueError(f"No visible {origin[0]} marker {origin[1]}.")
+        exclude = origin
+        origin = tuple(marker)
+
+    lat, lon = float(origin[0]), float(origin[1])
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Coordinates {lat}, {lon} are out of range.")
+    return func.geography(ST_SetSRID(ST_MakePoint(lon, lat), 4326)), exclude
+
+def _search_query(session, uid, kind, origin, filters):
+    """
+    Queries the markers of kind visible to the given user, each with its
+    distance in meters from origin.
+    """
+    model, link = SEARCH_KINDS[kind]
+    codes = get_community_codes(uid)
+    point, exclude = _search_origin(session, origin, codes)
+    # matches the geography index expression so it can be used
+    crds = func.geography(model.crds)
+
+    query = session.query(
+        *serializers.columns(model), _communities(model, link, codes),
+        ST_Distance(crds, point).label("distance")
+    ).filter(_visible(model, link, codes))
+
+    if exclude and exclude[0] == kind:
+        query = query.filter(model.id != exclude[1])
+    if kind == "sightings":
+        query = query.filter(*_sighting_filters(filters))
+    return query, crds, point
+
+def search_radius(uid, kind, origin, meters, limit=None, filters=None):
+    """
+    Gets the markers of kind, "cameras" or "sightings", visible to the 
+    given user within meters of origin, nearest first. origin is a (lat,
+    lon) pair or a (kind, id) pair naming a marker. Sightings can be 
+    narrowed by the sighting filters.
+    """
+    try:
+        with _session() as session:
+            query, crds, point = _search_query(session, uid, kind, origin, filters)
+            query = query.filter(ST_DWithin(crds, point, meters)).order_by("distance")
+            if limit:
+                query = query.limit(limit)
+            return _read_markers(query)
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+def search_nearest(uid, kind, origin, k, filters=None):
+    """
+    Gets the k markers of kind visible to the given user nearest to 
+    origin, nearest first, found with a k-nearest-neighbour index scan.
+    """
+    try:
+        with _session() as session:
+            query, crds, point = _search_query(session, uid, kind, origin, filters)
+            query = query.order_by(crds.op('<->')(point)).limit(k)
+            return _read_markers(query)
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+#-----------------------------------------------------------------------
+# Section: Vector Tiles
+#-----------------------------------------------------------------------
+
+# layer name -> (table, geometry column, join table, tile attributes)
+TILE_LAYERS = {
+    "cameras": ("cameras", "crds", "camera_communities",
+                "id, camera_id, site, status, type, date::text AS date"),
+    "sightings": ("sightings", "crds", "sighting_communities",
+                  "id, title, species, observer, number, type, "
+                  "date::text AS date"),
+    "areas": ("geoareas", "geom", "geoarea_communities",
+              "id, name, description"),
+}
+
+def get_tile(layer, z, x, y, codes):
+    """
+    Builds the Mapbox Vector Tile z/x/y of layer from the markers shared 
+    with any of the community codes.
+    """
+    try:
+        table, column, link, attributes = TILE_LAYERS[layer]
+        query = text(f"""
+            WITH bounds AS (
+                SELECT ST_TileEnvelope(:z, :x, :y) AS env
+            ), features AS (
+                SELECT {attributes},
+                    ST_AsMVTGeom(ST_Transform(t.{column}, 3857), bounds.env) AS geom
+                FROM {table} t, bounds
+                WHERE ST_Intersects(t.{column}, ST_Transform(bounds.env, 4326))
+                AND EXISTS (
+                    SELECT 1 FROM {link} l
+                    WHERE l.id = t.id AND l.code = ANY(:codes)
+                )
+            )
+            SELECT ST_AsMVT(features, :layer, 4096, 'geom') FROM features
+        """)
+
+        with _session() as session:
+            tile = session.execute(query, {
+                "z": z, "x": x, "y": y,
+                "codes": list(codes),
+                "layer": layer
+            }).scalar()
+            return bytes(tile) if tile else b""
+        
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
 #-----------------------------------------------------------------------
 # Section: Communities
 #-----------------------------------------------------------------------
@@ -168,7 +890,7 @@ def get_areas(uid):
 def get_communities(uid, code=None):
     """Gets all communities that the given user is a member of."""
     try:
-        with Session() as session:
+        with _session() as session:
             query = session.query(Communities).join(
                 UserCommunities, Communities.code == UserCommunities.code
             ).filter(UserCommunities.uid == uid)
@@ -185,8 +907,30 @@ def get_communities(uid, code=None):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+def get_community_codes(uid):
+    """Gets the sorted codes of all communities the given user is in."""
+    return get_synced_codes(uid)[0]
+
+def get_synced_codes(uid):
+    """
+    Gets the sorted codes of all communities the given user is in, and
+    a sync cursor taken before they were read. Cached codes miss any
+    community joined or left since their cursor.
+    """
+    key = f"codes:{uid}"
+    entry = cache.markers.get(key)
+    if entry is None:
+        with _session() as session:
+            cursor = _cursor(session)
+            codes = session.query(UserCommunities.code).filter(
+                UserCommunities.uid == uid
+            ).order_by(UserCommunities.code).all()
+            entry = {"codes": [code for code, in codes], "cursor": cursor}
+        cache.markers.set(key, entry, [f"user:{uid}"])
+    return tuple(entry["codes"]), entry["cursor"]
+
 def get_members(code):
-    with Session() as session:
+    with _session() as session:
         members = (
             session.query(Users.name, Users.email)
             .join(UserCommunities, UserCommunities.uid == Users.uid)
@@ -207,7 +951,7 @@ def get_members(code):
 def get_info(uid):
     """Gets the user's info from their uid."""
     try:
-        with Session() as session:
+        with _session() as session:
             query = session.query(
                 Users
             ).filter_by(
@@ -222,7 +966,7 @@ def get_info(uid):
 def add_user(uid, name, email):
     """Adds a user with specified uid, name, and email."""
     try:
-        with Session() as session:
+        with _session() as session:
             user = Users(
                 uid = uid,
                 name = name, 
@@ -243,35 +987,61 @@ def add_user(uid, name, email):
 # Section: Camera Traps
 #-----------------------------------------------------------------------
 
+def _schedule(status, placed):
+    """
+    Parses a "next,daysAhead" status into its next action and due date,
+    counting days from placed, the date the status was set. Other 
+    statuses have no schedule.
+    """
+    match = STATUS_PATTERN.match(status or '')
+    if not match:
+        return None, None
+    if placed.tzinfo is not None:
+        placed = placed.astimezone(LOCAL_TIMEZONE)
+    return match.group(1), placed.date() + timedelta(days=int(match.group(2)))
+
+def _camera_values(data, owner):
+    """Validates camera data and converts it to column values."""
+    # create geometry with location data
+    lat, lon = float(data['lat']), float(data['lon'])
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Coordinates {lat}, {lon} are out of range.")
+    point = Point(lon, lat)
+    crds_val = from_shape(point, srid=4326)
+    # clean date/time format; naive times are taken to be local
+    dt_aware = parser.isoparse(data['datetime'])
+    if dt_aware.tzinfo is None:
+        dt_aware = dt_aware.replace(tzinfo=LOCAL_TIMEZONE)
+    # correct status
+    status = data["next"] + ',' + str(data["daysAhead"])
+    next_action, due_date = _schedule(status, dt_aware)
+
+    return {
+        "owner": owner,
+        "site": data['site'],
+        "crds": crds_val,
+        "status": status,
+        "next_action": next_action,
+        "due_date": due_date,
+        "date": dt_aware,
+        "camera_id": data['camera_id'],
+        "type": data['type'],
+        "perc": int(data['perc']),
+        "mem": data['mem'],
+        "lock": data.get('lock'), 
+        "comments": data.get('comment')
+    }
+
 def add_camera(data):
     """Adds a camera trap with specified data."""
     try:
-        with Session() as session:
+        with _session() as session:
             owner = get_info(data['uid']).name
-            # create geometry with location data
-            point = Point(data['lon'], data['lat'])
-            crds_val = from_shape(point, srid=4326)
-            # clean date/time format
-            dt_aware = parser.isoparse(data['datetime'])
-            # correct status
-            status = data["next"] + ',' + data["daysAhead"]
-
-            camera = Cameras(
-                owner = owner,
-                site = data['site'],
-                crds = crds_val,
-                status = status,
-                date = dt_aware,
-                camera_id = data['camera_id'],
-                type = data['type'],
-                perc = data['perc'],
-                mem = data['mem'],
-                lock = data['lock'], 
-                comments = data['comment']
-            )
+            camera = Cameras(**_camera_values(data, owner))
             
             session.add(camera)
             session.flush()
+            _store_members(session, GeoAreaCameras, [(camera.id, to_shape(camera.crds))])
 
             # add to join table for community access
             for code in data.get("communities").split(','):
@@ -281,7 +1051,9 @@ def add_camera(data):
                 )
                 session.add(join_access)
 
+            _publish(session, Cameras, CameraCommunities, "cameras", [camera.id], "added")
             session.commit()
+            cache.markers.invalidate(data.get("communities").split(','))
             
             print('A camera is being added.')
             return {"success": True, "message": "Camera added."}
@@ -292,10 +1064,77 @@ def add_camera(data):
         print(str(e))
         return {"success": False, "message": str(e)}
 
+def add_cameras(uid, rows, communities):
+    """
+    Adds many camera traps, e.g. a transect, in one transaction. All rows
+    are validated first; valid rows are inserted in batches and invalid 
+    or already registered rows are reported per row instead of failing 
+    the whole import.
+    """
+    try:
+        with _session() as session:
+            owner = get_info(uid).name
+            errors = []
+            values = {}
+
+            for i, row in enumerate(rows, start=1):
+                try:
+                    value = _camera_values(row, owner)
+                except Exception as e:
+                    errors.append({"row": i, "message": f"Invalid row: {e!r}"})
+                    continue
+
+                key = (value["camera_id"], value["date"])
+                if key in values:
+                    errors.append({"row": i, "message": "Duplicate of an earlier row."})
+                    continue
+                values[key] = (i, value)
+
+            # existing cameras are skipped and reported as duplicates
+            ids = {}
+            batch = list(values.values())
+            for start in range(0, len(batch), INSERT_BATCH_SIZE):
+                chunk = [value for _, value in batch[start:start + INSERT_BATCH_SIZE]]
+                inserted = session.execute(
+                    insert(Cameras).values(chunk).on_conflict_do_nothing(
+                        constraint='uq_camera_id_date'
+                    ).returning(Cameras.id, Cameras.camera_id, Cameras.date)
+                ).all()
+                ids.update({(camera_id, date): id for id, camera_id, date in inserted})
+
+            links = []
+            markers = []
+            for key, (i, value) in values.items():
+                if key not in ids:
+                    errors.append({"row": i, "message": "This camera has already been registered."})
+                    continue
+                links += [{"id": ids[key], "code": code} for code in communities]
+                markers.append((ids[key], to_shape(value["crds"])))
+            if links:
+                session.execute(insert(CameraCommunities), links)
+            _store_members(session, GeoAreaCameras, markers)
+            _publish(session, Cameras, CameraCommunities, "cameras",
+                     [id for id, _ in markers], "added")
+
+            session.commit()
+            if ids:
+                cache.markers.invalidate(communities)
+
+            errors.sort(key=lambda error: error["row"])
+            print(f'{len(ids)} cameras are being added.')
+            return {"success": not errors, 
+                    "message": f"{len(ids)} of {len(rows)} cameras added.",
+                    "added": len(ids),
+                    "errors": errors}
+
+    except Exception as e:
+        print(str(e))
+        return {"success": False, "message": str(e)}
+
 def update_status(id, status):
     """Updates the camera's status to status with camera_id id."""
     try:
-        with Session() as session:
+        with _session() as session:
             # parse the id
             cam, date_str = id.split('-', 1)
             date = parser.isoparse(date_str)
@@ -309,12 +1148,129 @@ def update_status(id, status):
             if not camera:
                 return {"success": False, "message": "Camera not found"}
             camera.status = status
+            camera.next_action, camera.due_date = _schedule(status, datetime.now(LOCAL_TIMEZONE))
+            codes = session.query(CameraCommunities.code).filter(
+                CameraCommunities.id == camera.id
+            ).all()
+            _publish(session, Cameras, CameraCommunities, "cameras", [camera.id], "updated")
             session.commit()
+            cache.markers.invalidate(code for code, in codes)
             return {"success": True, "message": f"Updated camera {id} status to {status}"}
         
     except Exception as e:
         return {"success": False, "message": str(e)}
     
+def _status_update(update):
+    """
+    Validates one update of update_statuses, getting the id or (camera_id,
+    date) key it names and its new status. Naive dates are local.
+    """
+    if not isinstance(update.get("status"), str):
+        raise ValueError("An update needs a status.")
+    if "id" in update:
+        return int(update["id"]), update["status"]
+    cam, date_str = str(update["camera"]).split('-', 1)
+    date = parser.isoparse(date_str)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=LOCAL_TIMEZONE)
+    return (cam, date), update["status"]
+
+def update_statuses(uid, updates):
+    """
+    Updates the statuses of many cameras the given user has access to in
+    one transaction. Each update names its camera by database id, or by
+    "<camera_id>-<isodate>" as in update_status, and gives the new 
+    status. Invalid updates and unknown cameras are reported per update.
+    """
+    try:
+        with _session() as session:
+            parsed = []
+            for update in updates:
+                try:
+                    parsed.append(_status_update(update))
+                except Exception as e:
+                    parsed.append(e)
+
+            valid = [update for update in parsed if not isinstance(update, Exception)]
+            ids = [ref for ref, _ in valid if isinstance(ref, int)]
+            keys = [ref for ref, _ in valid if isinstance(ref, tuple)]
+            conditions = []
+            if ids:
+                conditions.append(Cameras.id.in_(ids))
+            if keys:
+                conditions.append(tuple_(Cameras.camera_id, Cameras.date).in_(keys))
+            cameras = session.query(Cameras).filter(
+                or_(*conditions),
+                _visible(Cameras, CameraCommunities, get_community_codes(uid))
+            ).all() if conditions else []
+            by_ref = {camera.id: camera for camera in cameras}
+            # aware datetimes for the same instant compare and hash equal
+            by_ref.update({(camera.camera_id, camera.date): camera for camera in cameras})
+
+            results = []
+            updated = []
+            now = datetime.now(LOCAL_TIMEZONE)
+            for update in parsed:
+                if isinstance(update, Exception):
+                    results.append({"success": False, "message": f"Invalid update: {update!r}"})
+                    continue
+                ref, status = update
+                camera = by_ref.get(ref)
+                if camera is None:
+                    results.append({"success": False, "message": "Camera not found"})
+                    continue
+                camera.status = status
+                camera.next_action, camera.due_date = _schedule(status, now)
+                updated.append(camera.id)
+                results.append({"success": True, "id": camera.id})
+
+            codes = session.query(CameraCommunities.code).filter(
+                CameraCommunities.id.in_(updated)
+            ).distinct().all() if updated else []
+            _publish(session, Cameras, CameraCommunities, "cameras", updated, "updated")
+            session.commit()
+            cache.markers.invalidate(code for code, in codes)
+            return {"success": all(result["success"] for result in results),
+                    "message": f"Updated {len(updated)} of {len(updates)} cameras.",
+                    "results": results}
+
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+def backfill_schedules():
+    """
+    Parses the schedules of cameras stored before schedules were kept.
+    Returns the number of cameras given a schedule.
+    """
+    with Session() as session:
+        cameras = session.query(Cameras).filter(
+            Cameras.next_action.is_(None),
+            Cameras.status.regexp_match(STATUS_PATTERN.pattern)
+        ).all()
+        for camera in cameras:
+            camera.next_action, camera.due_date = _schedule(camera.status, camera.date)
+        session.commit()
+        return len(cameras)
+
+def get_due_cameras(uid, before, next_action=None):
+    """
+    Gets the cameras the given user has access to that are due for 
+    servicing on or before the date before, soonest first, optionally 
+    only those whose next action is next_action.
+    """
+    try:
+        with _session() as session:
+            conditions = [Cameras.due_date <= before]
+            if next_action:
+                conditions.append(Cameras.next_action == next_action)
+            query = _marker_query(session, Cameras, CameraCommunities, uid,
+                                  conditions=conditions)
+            query = query.order_by(None).order_by(Cameras.due_date, Cameras.id)
+            return _read_markers(query)
+
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+    
 #-----------------------------------------------------------------------
 # Section: Wildlife Sightings
 #-----------------------------------------------------------------------
@@ -322,9 +1278,7 @@ def update_status(id, status):
 def add_sighting(data, image):
     """Adds a wildlife sighting with specified data."""
     try:
-        with Session() as session:
-            upload_result = cloudinary.uploader.upload(image)
-            url = upload_result.get("secure_url")
+        with _session() as session:
             owner = get_info(data['uid']).name
             # create geometry with location data
             crds = json.loads(data['crds'])
@@ -343,11 +1297,15 @@ def add_sighting(data, image):
                 species = data['species'],
                 number = data['number'],
                 type = data['type'],
-                url = url,
+                url = '',
+                image_status = 'pending',
                 comments = data['comments']
             )
             session.add(sighting)
             session.flush()
+            _store_members(session, GeoAreaSightings, [(sighting.id, point)])
+            # the image is uploaded in the background after the commit
+            job_id = uploads.enqueue(session, 'sighting', sighting.id, image)
 
             # add to join table for community access
             for code in data.get("communities").split(','):
@@ -357,7 +1315,11 @@ def add_sighting(data, image):
                 )
                 session.add(join_access)
 
+            _publish(session, Sightings, SightingCommunities, "sightings",
+                     [sighting.id], "added")
             session.commit()
+            uploads.submit(job_id)
+            cache.markers.invalidate(data.get("communities").split(','))
             
             print('A sighting is being added.')
             return {"success": True, "message": "Sighting added."}
@@ -369,6 +1331,113 @@ def add_sighting(data, image):
         print(str(e))
         return {"success": False, "message": str(e)}
 
+def add_sightings(data, images):
+    """
+    Adds the wildlife sightings in a batch of camera-trap images. Capture
+    times and coordinates are read from each image's EXIF data, falling
+    back to the form's datetime and crds, and each burst of images from 
+    one camera becomes a single sighting whose first image is uploaded 
+    in the background.
+    """
+    paths = []
+    keep = set()
+    try:
+        paths = [uploads.spool(image) for image in images]
+        names = {path: image.filename for path, image in zip(paths, images)}
+        fallback_date = parser.isoparse(data['datetime']) if data.get('datetime') else None
+        fallback_crds = json.loads(data['crds']) if data.get('crds') else None
+
+        errors = []
+        readings = []
+        for reading in exif.read_all(paths):
+            if reading["datetime"] is None:
+                reading["datetime"] = fallback_date
+            if reading["lat"] is None and fallback_crds:
+                reading["lat"], reading["lon"] = fallback_crds['lat'], fallback_crds['lon']
+            if reading["datetime"] is None or reading["lat"] is None:
+                errors.append({"file": names[reading["path"]],
+                               "message": "No capture time or location was given."})
+                continue
+            if reading["datetime"].tzinfo is None:
+                reading["datetime"] = reading["datetime"].replace(tzinfo=LOCAL_TIMEZONE)
+            readings.append(reading)
+        bursts = exif.group_bursts(readings)
+
+        with _session() as session:
+            owner = get_info(data['uid']).name
+            communities = data.get("communities").split(',')
+            values = [{
+                "title": data['title'],
+                "owner": owner,
+                "observer": data['observer'],
+                "crds": from_shape(Point(burst[0]["lon"], burst[0]["lat"]), srid=4326),
+                "date": burst[0]["datetime"],
+                "species": data['species'],
+                "number": int(data.get('number') or 1),
+                "type": data['type'],
+                "url": '',
+                "image_status": 'pending',
+                "comments": data.get('comments')
+            } for burst in bursts]
+
+            # sightings already registered are skipped and reported
+            ids = {}
+            for start in range(0, len(values), INSERT_BATCH_SIZE):
+                inserted = session.execute(
+                    insert(Sightings).values(values[start:start + INSERT_BATCH_SIZE])
+                    .on_conflict_do_nothing(constraint='uq_sight_obs_spe_date')
+                    .returning(Sightings.id, Sightings.date)
+                ).all()
+                ids.update({date: id for id, date in inserted})
+
+            links = []
+            jobs = []
+            markers = []
+            picked = []
+            for burst in bursts:
+                id = ids.pop(burst[0]["datetime"], None)
+                if id is None:
+                    errors.append({"file": names[burst[0]["path"]],
+                                   "message": "This sighting has already been registered."})
+                    continue
+                links += [{"id": id, "code": code} for code in communities]
+                markers.append((id, Point(burst[0]["lon"], burst[0]["lat"])))
+                jobs.append({"kind": 'sighting', "target": str(id), "path": burst[0]["path"]})
+                picked.append(burst[0]["path"])
+
+            job_ids = []
+            if jobs:
+                session.execute(insert(SightingCommunities), links)
+                _store_members(session, GeoAreaSightings, markers)
+                _publish(session, Sightings, SightingCommunities, "sightings",
+                         [id for id, _ in markers], "added")
+                job_ids = session.execute(
+                    insert(UploadJobs).values(jobs).returning(UploadJobs.id)
+                ).scalars().all()
+
+            session.commit()
+            # committed jobs point at these images, even if submitting fails
+            keep.update(picked)
+            for job_id in job_ids:
+                uploads.submit(job_id)
+            if job_ids:
+                cache.markers.invalidate(communities)
+
+            print(f'{len(job_ids)} sightings are being added.')
+            return {"success": not errors,
+                    "message": f"{len(job_ids)} sightings added from {len(images)} images.",
+                    "added": len(job_ids),
+                    "errors": errors}
+
+    except Exception as e:
+        print(str(e))
+        return {"success": False, "message": str(e)}
+    finally:
+        # only the images picked for upload stay spooled
+        for path in paths:
+            if path not in keep and os.path.exists(path):
+                os.remove(path)
+
 #-----------------------------------------------------------------------
 # Section: Geographic Areas
 #-----------------------------------------------------------------------
@@ -376,7 +1445,7 @@ def add_sighting(data, image):
 def add_area(name, description, geom, communities):
     """Adds a wildlife sighting with specified data."""
     try:
-        with Session() as session:
+        with _session() as session:
             area = GeoAreas(
                 name = name,
                 description = description,
@@ -384,6 +1453,8 @@ def add_area(name, description, geom, communities):
             )
             session.add(area)
             session.flush()
+            _store_levels(session, [area.id])
+            _store_area_members(session, [area.id])
 
             # add to join table for community access
             for code in communities:
@@ -393,7 +1464,21 @@ def add_area(name, description, geom, communities):
                 )
                 session.add(join_access)
 
+            events.publish(session, {
+                "type": "areas",
+                "action": "added",
+                "marker": {
+                    "id": area.id,
+                    "name": name,
+                    "description": description,
+                    "geom": mapping(to_shape(geom)),
+                    "communities": list(communities)
+                },
+                "communities": list(communities)
+            })
             session.commit()
+            areas.index.invalidate()
+            cache.markers.invalidate(communities)
             
             print('A user-defined area is being added.')
             return {"success": True, "message": "Area added."}
@@ -405,6 +1490,20 @@ def add_area(name, description, geom, communities):
         print(str(e))
         return {"success": False, "message": str(e)}
 
+def rebuild_areas():
+    """
+    Recomputes the simplified outlines of every area and which markers
+    each area contains.
+    """
+    with Session() as session:
+        area_ids = select(GeoAreas.id)
+        _store_levels(session, area_ids)
+        session.query(GeoAreaCameras).delete()
+        session.query(GeoAreaSightings).delete()
+        _store_area_members(session, area_ids)
+        session.commit()
+    areas.index.invalidate()
+
 #-----------------------------------------------------------------------
 # Section: Communities
 #-----------------------------------------------------------------------
@@ -412,9 +1511,7 @@ def add_area(name, description, geom, communities):
 def add_community(data, image):
     """Adds a community with specified data."""
     try:
-        with Session() as session:
-            upload_result = cloudinary.uploader.upload(image)
-            url = upload_result.get("secure_url")
+        with _session() as session:
             owner = get_info(data['uid']).name
             code = gen_join_code(12)
 
@@ -423,10 +1520,15 @@ def add_community(data, image):
                 owner = owner,
                 name = data['name'],
                 description = data['description'],
-                imageUrl = url
+                imageUrl = '',
+                imageStatus = 'pending'
             )
             session.add(community)
+            session.flush()
+            # the image is uploaded in the background after the commit
+            job_id = uploads.enqueue(session, 'community', code, image)
             session.commit()
+            uploads.submit(job_id)
             
             print('A community is being added.')
             return {"success": True, "code": code, "message": "Community added."}
@@ -441,7 +1543,7 @@ def add_community(data, image):
 def join_community(uid, code):
     """Adds a user to a community."""
     try:
-        with Session() as session:
+        with _session() as session:
             # check if the user is already in the community
             existing = session.query(UserCommunities).filter_by(uid=uid, code=code).first()
             if existing:
@@ -450,9 +1552,29 @@ def join_community(uid, code):
             join = UserCommunities(uid=uid, code=code)
             session.add(join)
             session.commit()
+            cache.markers.invalidate([f"user:{uid}"])
             
             return get_communities(uid, code)[0]
 
     except Exception as e:
         print(str(e))
         return {"success": False, "message": str(e)}
+
+def leave_community(uid, code):
+    """Removes a user from a community."""
+    try:
+        with _session() as session:
+            deleted = session.query(UserCommunities).filter_by(
+                uid=uid, code=code
+            ).delete()
+            if not deleted:
+                return {"success": False, "message": f"User {uid} is not a member of community {code}."}
+
+            session.add(CommunityDepartures(uid=uid, code=code))
+            session.commit()
+            cache.markers.invalidate([f"user:{uid}"])
+            return {"success": True, "message": "Left community."}
+
+    except Exception as e:
+        print(str(e))
+        return {"success": False, "message": str(e)}
@@ -0,0 +1,117 @@
+"""
+Uploads camera-trap photos to Google Drive. Files are sent in parallel
+as resumable, chunked uploads read straight from the request's file
+streams.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# drive.py
+#-----------------------------------------------------------------------
+
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#-----------------------------------------------------------------------
+
+UPLOAD_FOLDER_ID = os.environ.get('UPLOAD_FOLDER_ID')
+SCOPES = ['https://www.googleapis.com/auth/drive']
+# resumable chunks must be a multiple of 256 KB
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_WORKERS = int(os.environ.get('DRIVE_UPLOAD_WORKERS', 8))
+
+#-----------------------------------------------------------------------
+
+class DriveClient:
+    """
+    Creates files through the Drive API. The underlying HTTP transport
+    is not thread safe, so each worker thread builds its own service.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._local = threading.local()
+
+    def _service(self):
+        if not hasattr(self._local, 'service'):
+            from googleapiclient.discovery import build
+            self._local.service = build('drive', 'v3',
+                                        credentials=self.credentials,
+                                        cache_discovery=False)
+        return self._local.service
+
+    def create(self, name, stream, mimetype, folder_id):
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(stream, mimetype=mimetype,
+                                  chunksize=CHUNK_SIZE, resumable=True)
+        request = self._service().files().create(
+            body={'name': name, 'parents': [folder_id]},
+            media_body=media,
+            fields='id'
+        )
+        response = None
+        while response is None:
+            _, response = request.next_chunk()
+        return response['id']
+
+class LocalDriveClient:
+    """Writes files into a local directory, e.g. for tests."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, name, stream, mimetype, folder_id):
+        folder = os.path.join(self.directory, folder_id or '')
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, name), 'wb') as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+        return name
+
+#-----------------------------------------------------------------------
+
+_client = None
+# shared by all requests, so each thread's Drive service is built once
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                               thread_name_prefix='drive-upload')
+
+def get_client():
+    """
+    Gets the Drive client, creating it from the service account. The
+    Google client libraries are only imported here, on first use.
+    """
+    global _client
+    if _client is None:
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_file(
+            os.environ['GOOGLE_SERVICE_ACCOUNT_FILE'], scopes=SCOPES
+        )
+        _client = DriveClient(credentials)
+    return _client
+
+def set_client(client):
+    """Replaces the Drive client, e.g. with a local stand-in."""
+    global _client
+    _client = client
+
+def upload_files(files, folder_id=None):
+    """
+    Uploads the given request files to the Drive folder folder_id in
+    parallel on the shared upload threads. Returns one result per file,
+    in order.
+    """
+    client = get_client()
+    folder_id = folder_id or UPLOAD_FOLDER_ID
+
+    def upload(file):
+        try:
+            file_id = client.create(file.filename, file.stream,
+                                    file.mimetype, folder_id)
+            return {"name": file.filename, "success": True, "id": file_id}
+        except Exception as e:
+            return {"name": file.filename, "success": False, "message": str(e)}
+
+    return list(_executor.map(upload, files))
@@ -0,0 +1,175 @@
+"""
+Broadcasts newly committed markers to the members of the communities
+they are shared with, for the Server-Sent Events stream. Events are
+only delivered once the transaction that published them commits. The
+in-process broker serves a single worker; with several workers, set
+MARKER_EVENTS=postgres to fan events out through LISTEN/NOTIFY.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# events.py
+#-----------------------------------------------------------------------
+
+import os
+import json
+import time
+import queue
+import select
+import threading
+import sqlalchemy, sqlalchemy.event
+import models
+
+#-----------------------------------------------------------------------
+
+CHANNEL = 'afc_markers'
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_LIMIT = 7900
+QUEUE_SIZE = 256
+KEEPALIVE = 15
+RETRY_DELAY = 5
+
+#-----------------------------------------------------------------------
+
+class Subscription:
+    """Queue of the events shared with any of a set of community codes."""
+
+    def __init__(self, broker, codes):
+        self.broker = broker
+        self.codes = set(codes)
+        self.overflowed = False
+        self._queue = queue.Queue(QUEUE_SIZE)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+        Waits up to timeout seconds for the next event, returning None if
+        there is none. A subscriber that fell too far behind gets a
+        single resync event instead of the events it missed.
+        """
+        if self.overflowed:
+            self.overflowed = False
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            return {"type": "resync"}
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.broker.unsubscribe(self)
+
+class LocalBroker:
+    """Delivers events to the subscribers in this process."""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, codes):
+        subscription = Subscription(self, codes)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, session, event):
+        """Queues event for delivery once session commits."""
+        session.info.setdefault('events', []).append(event)
+
+    def deliver(self, event):
+        codes = set(event["communities"])
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.codes & codes:
+                subscription.put(event)
+
+class PostgresBroker(LocalBroker):
+    """
+    Publishes events with NOTIFY, which Postgres sends on commit, and
+    delivers the notifications received by a listener thread. The
+    listener starts with the first subscriber.
+    """
+
+    def __init__(self, connect):
+        super().__init__()
+        self._connect = connect
+        self._listener = None
+
+    def subscribe(self, codes):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True,
+                                                  name='marker-events')
+                self._listener.start()
+        return super().subscribe(codes)
+
+    def publish(self, session, event):
+        payload = json.dumps(event, default=str)
+        if len(payload.encode()) > NOTIFY_LIMIT:
+            # clients fetch partial markers, e.g. large areas, themselves
+            payload = json.dumps(dict(event, marker={"id": event["marker"]["id"]},
+                                      partial=True))
+        session.execute(sqlalchemy.text("SELECT pg_notify(:channel, :payload)"),
+                        {"channel": CHANNEL, "payload": payload})
+
+    def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {CHANNEL}')
+                while True:
+                    if not select.select([connection], [], [], KEEPALIVE)[0]:
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.deliver(json.loads(connection.notifies.pop(0).payload))
+            except Exception as e:
+                print(f'Marker event listener failed: {e}')
+                if connection is not None:
+                    connection.close()
+                time.sleep(RETRY_DELAY)
+
+#-----------------------------------------------------------------------
+
+def create_broker():
+    """Creates the broker named by MARKER_EVENTS: postgres or local."""
+    if os.environ.get('MARKER_EVENTS') == 'postgres':
+        return PostgresBroker(models.connect)
+    return LocalBroker()
+
+broker = create_broker()
+
+def set_broker(new_broker):
+    """Replaces the marker event broker, e.g. with a local stand-in."""
+    global broker
+    broker = new_broker
+
+def publish(session, event):
+    broker.publish(session, event)
+
+def _after_commit(session):
+    for event in session.info.pop('events', []):
+        broker.deliver(event)
+
+def _after_rollback(session):
+    session.info.pop('events', None)
+
+sqlalchemy.event.listen(models.Session, 'after_commit', _after_commit)
+sqlalchemy.event.listen(models.Session, 'after_rollback', _after_rollback)
@@ -0,0 +1,142 @@
+"""
+Extracts capture times, GPS coordinates, and camera identifiers from
+camera-trap images, and groups images from the same camera into bursts.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# exif.py
+#-----------------------------------------------------------------------
+
+import os
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+#-----------------------------------------------------------------------
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+MAKE, MODEL = 0x010F, 0x0110
+DATETIME_ORIGINAL = 0x9003
+OFFSET_TIME_ORIGINAL = 0x9011
+BODY_SERIAL_NUMBER = 0xA431
+
+# images from one camera less than this far apart form one burst
+BURST_GAP = timedelta(seconds=int(os.environ.get('BURST_GAP_SECONDS', 60)))
+MAX_WORKERS = int(os.environ.get('EXIF_WORKERS', os.cpu_count() or 1))
+# seconds one batch of images may take to read before the request fails
+READ_TIMEOUT = float(os.environ.get('EXIF_TIMEOUT', 120))
+
+#-----------------------------------------------------------------------
+
+def _degrees(dms, ref):
+    degrees = float(dms[0]) + float(dms[1]) / 60 + float(dms[2]) / 3600
+    return -degrees if ref in ('S', 'W') else degrees
+
+def read_exif(path):
+    """
+    Reads the capture time, GPS coordinates, and camera of the image at
+    path. Missing fields are None.
+    """
+    # imported here to keep it out of worker startup
+    from PIL import Image
+
+    result = {"path": path, "datetime": None, "lat": None, "lon": None,
+              "camera": None}
+    try:
+        with Image.open(path) as image:
+            exif = image.getexif()
+            details = exif.get_ifd(EXIF_IFD)
+            gps = exif.get_ifd(GPS_IFD)
+    except Exception:
+        return result
+
+    taken = details.get(DATETIME_ORIGINAL)
+    if taken:
+        offset = details.get(OFFSET_TIME_ORIGINAL)
+        try:
+            stamp = datetime.strptime(taken.strip(), '%Y:%m:%d %H:%M:%S')
+            if offset:
+                stamp = datetime.fromisoformat(stamp.isoformat() + offset.strip())
+            result["datetime"] = stamp
+        except ValueError:
+            pass
+
+    # GPS tags 1-4: latitude ref, latitude, longitude ref, longitude
+    if all(tag in gps for tag in (1, 2, 3, 4)):
+        result["lat"] = _degrees(gps[2], gps[1])
+        result["lon"] = _degrees(gps[4], gps[3])
+
+    serial = details.get(BODY_SERIAL_NUMBER)
+    model = ' '.join(str(exif.get(tag, '')).strip() for tag in (MAKE, MODEL)).strip()
+    result["camera"] = serial or model or None
+    return result
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # forking the threaded server process can copy held locks
+            # into the children and deadlock them
+            _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS,
+                                        mp_context=multiprocessing.get_context('forkserver'))
+        return _pool
+
+def _discard_pool(pool):
+    """Drops a broken or stuck pool so the next read starts a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def read_all(paths):
+    """
+    Reads the EXIF data of many images in a process pool. A pool whose
+    worker died, e.g. killed reading a bad image, is replaced and the
+    read retried once; reads taking over READ_TIMEOUT seconds raise
+    TimeoutError.
+    """
+    for attempt in range(2):
+        pool = _get_pool()
+        try:
+            return list(pool.map(read_exif, paths, chunksize=16,
+                                 timeout=READ_TIMEOUT))
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            if attempt:
+                raise
+        except TimeoutError:
+            _discard_pool(pool)
+            raise
+
+#-----------------------------------------------------------------------
+
+def group_bursts(images):
+    """
+    Groups images read by read_exif into bursts: runs of images from the
+    same camera taken less than BURST_GAP apart. Images must have a
+    datetime. Bursts are ordered by camera, then by capture time.
+    """
+    def key(image):
+        stamp = image["datetime"]
+        # compare naive and aware times on the same footing
+        return (image["camera"] or '', stamp.replace(tzinfo=None))
+
+    bursts = []
+    last = None
+    for image in sorted(images, key=key):
+        camera, stamp = key(image)
+        if last and last[0] == camera and stamp - last[1] < BURST_GAP:
+            bursts[-1].append(image)
+        else:
+            bursts.append([image])
+        last = (camera, stamp)
+    return bursts
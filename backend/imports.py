@@ -0,0 +1,54 @@
+"""Reads bulk camera imports from uploaded CSV or GeoJSON files."""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# imports.py
+#-----------------------------------------------------------------------
+
+import io
+import csv
+import json
+
+#-----------------------------------------------------------------------
+
+GEOJSON_TYPES = ('application/geo+json', 'application/json')
+
+def _is_geojson(file):
+    name = (file.filename or '').lower()
+    return name.endswith(('.geojson', '.json')) or file.mimetype in GEOJSON_TYPES
+
+def read_cameras(file):
+    """
+    Reads camera rows from an uploaded file. CSV files have one column
+    per camera field, with coordinates given either as lat and lon or as
+    a single "lat, lon" crds column. GeoJSON files have one Point feature
+    per camera with the remaining fields as properties.
+    """
+    if _is_geojson(file):
+        collection = json.load(file.stream)
+        rows = []
+        for feature in collection.get('features', []):
+            row = dict(feature.get('properties') or {})
+            geometry = feature.get('geometry') or {}
+            coordinates = geometry.get('coordinates')
+            # malformed points are reported when the row is validated
+            if (geometry.get('type') == 'Point' and isinstance(coordinates, list)
+                    and len(coordinates) >= 2
+                    and all(isinstance(x, (int, float)) for x in coordinates[:2])):
+                row['lon'], row['lat'] = coordinates[:2]
+            rows.append(row)
+        return rows
+
+    text = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+    rows = []
+    for row in csv.DictReader(text):
+        row = {key.strip(): value.strip() for key, value in row.items()
+               if key and value is not None}
+        if 'crds' in row and 'lat' not in row:
+            crds = [x.strip() for x in row['crds'].split(',')]
+            # malformed coordinates are reported when the row is validated
+            if len(crds) == 2:
+                row['lat'], row['lon'] = crds
+        rows.append(row)
+    return rows
@@ -0,0 +1,94 @@
+"""
+Manages the database schema, which is no longer created when models is
+imported. Run from backend/ once per deployment, before starting the
+workers:
+
+    python manage.py init-db    creates missing tables and their indexes
+    python manage.py migrate    also adds the columns and indexes added
+                                to existing tables since they were
+                                created, and fills in derived data
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# manage.py
+#-----------------------------------------------------------------------
+
+import argparse
+import dotenv
+dotenv.load_dotenv()
+
+import sqlalchemy
+from sqlalchemy.schema import CreateColumn
+from geoalchemy2 import Geometry
+from models import Base, get_engine
+
+#-----------------------------------------------------------------------
+
+def init_db():
+    """Creates the PostGIS extension and any missing tables."""
+    engine = get_engine()
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text('CREATE EXTENSION IF NOT EXISTS postgis'))
+    Base.metadata.create_all(engine)
+
+def _add_columns(connection):
+    inspector = sqlalchemy.inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # new columns are nullable or have a server default
+            ddl = CreateColumn(column).compile(dialect=connection.dialect)
+            connection.execute(sqlalchemy.text(
+                f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {ddl}'
+            ))
+            print(f'Added column {table.name}.{column.name}')
+
+def _add_indexes(connection):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+        # spatial indexes are otherwise only made with their table
+        for column in table.columns:
+            if isinstance(column.type, Geometry) and column.type.spatial_index:
+                connection.execute(sqlalchemy.text(
+                    f'CREATE INDEX IF NOT EXISTS idx_{table.name}_{column.name} '
+                    f'ON {table.name} USING gist ({column.name})'
+                ))
+
+def migrate():
+    """
+    Brings an existing database up to the current schema. Safe to run
+    repeatedly.
+    """
+    # imported here so init-db does not need the app's dependencies
+    import database
+
+    init_db()
+    with get_engine().begin() as connection:
+        _add_columns(connection)
+        _add_indexes(connection)
+
+    print(f'Scheduled {database.backfill_schedules()} cameras.')
+    database.rebuild_areas()
+    print('Rebuilt area outlines and membership.')
+
+#-----------------------------------------------------------------------
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('command', choices=['init-db', 'migrate'])
+    args = arg_parser.parse_args()
+
+    if args.command == 'init-db':
+        init_db()
+    else:
+        migrate()
+    print('Done.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Records per-route request latency, SQL statement counts and durations,
+and JSON serialization time, and exposes them with the cache, pool, and
+token stats in Prometheus text format for the admin-only /metrics
+route. Requests slower than SLOW_REQUEST_MS are logged with their query
+breakdown.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# metrics.py
+#-----------------------------------------------------------------------
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from flask import g, has_app_context, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#-----------------------------------------------------------------------
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+SLOW_QUERIES_LOGGED = 5
+
+#-----------------------------------------------------------------------
+
+class Histogram:
+    """Cumulative Prometheus histogram with one series per label set."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                for bound, bucket in zip(BUCKETS, counts):
+                    lines.append(f'{self.name}_bucket{_labels(key, le=bound)} {bucket}')
+                lines.append(f'{self.name}_bucket{_labels(key, le="+Inf")} {count}')
+                lines.append(f'{self.name}_sum{_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_labels(key)} {count}')
+        return lines
+
+class Counter:
+    """Prometheus counter with one series per label set."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in self._series.items():
+                lines.append(f'{self.name}{_labels(key)} {value}')
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(key, **extra):
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _gauges(name, help, values):
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+    for key, value in values.items():
+        if isinstance(value, (int, float)):
+            lines.append(f'{name}{_labels((("stat", key),))} {value}')
+    return lines
+
+#-----------------------------------------------------------------------
+
+# seconds spent on each startup step of this worker
+startup = {}
+
+def record_startup(step, seconds):
+    startup[step] = seconds
+
+request_seconds = Histogram('afc_request_seconds', 'Request latency by route.')
+requests_total = Counter('afc_requests_total', 'Requests by route and status.')
+sql_seconds = Histogram('afc_sql_seconds', 'SQL statement duration by route.')
+serialize_seconds = Histogram('afc_serialize_seconds', 'JSON serialization time by route.')
+
+_local = threading.local()
+
+def current_route():
+    """
+    Gets the route label for work on this thread: the request's route,
+    the route captured for a worker thread, or background.
+    """
+    if has_request_context() and request.url_rule:
+        return request.url_rule.rule
+    return getattr(_local, 'route', None) or 'background'
+
+@contextmanager
+def capture(route, queries):
+    """
+    Attributes the statements run on this thread, e.g. by a worker doing
+    part of a request, to route, and appends their (seconds, statement)
+    pairs to queries for the request to merge into its breakdown.
+    """
+    _local.route, _local.queries = route, queries
+    try:
+        yield
+    finally:
+        _local.route = _local.queries = None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+    sql_seconds.observe(seconds, route=current_route())
+    if has_app_context():
+        g.setdefault('sql_queries', []).append((seconds, statement))
+    elif getattr(_local, 'queries', None) is not None:
+        _local.queries.append((seconds, statement))
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # after_cursor_execute is skipped for failed statements
+    conn = context.connection
+    if conn is not None and context.cursor is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Records how long building each JSON response takes."""
+
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            g.serialize_seconds = g.get('serialize_seconds', 0.0) + seconds
+            serialize_seconds.observe(seconds, route=current_route())
+
+#-----------------------------------------------------------------------
+
+def _start_request():
+    g.request_start = time.perf_counter()
+
+def _finish_request(response):
+    seconds = time.perf_counter() - g.get('request_start', time.perf_counter())
+    route = current_route()
+    request_seconds.observe(seconds, route=route, method=request.method)
+    requests_total.inc(route=route, method=request.method, status=response.status_code)
+
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        queries = g.get('sql_queries', [])
+        print(f'Slow request {request.method} {route}: {seconds * 1000:.1f} ms, '
+              f'{len(queries)} queries in {sum(q[0] for q in queries) * 1000:.1f} ms, '
+              f'serialization {g.get("serialize_seconds", 0.0) * 1000:.1f} ms')
+        for query_seconds, statement in sorted(queries, reverse=True)[:SLOW_QUERIES_LOGGED]:
+            print(f'  {query_seconds * 1000:8.1f} ms  {" ".join(statement.split())[:200]}')
+    return response
+
+def render():
+    """Renders all metrics in Prometheus text format."""
+    import cache, models, tokens
+    lines = []
+    for metric in (request_seconds, requests_total, sql_seconds, serialize_seconds):
+        lines += metric.render()
+    lines += _gauges('afc_marker_cache', 'Marker cache counters.', cache.markers.stats())
+    lines += _gauges('afc_db_pool', 'Connection pool usage and waits.', models.get_pool_stats())
+    lines += _gauges('afc_token_cache', 'ID token cache counters.', tokens.verifier.stats())
+    lines += _gauges('afc_worker_startup_seconds', 'Worker startup time by step.', startup)
+    return '\n'.join(lines) + '\n'
+
+def init_app(app):
+    """Installs request and serialization timing."""
+    app.json = TimedJSONProvider(app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -9,18 +9,28 @@ use in database.py with the specified schema.
 # models.py
 #-----------------------------------------------------------------------
 
-import sqlalchemy, sqlalchemy.orm
-from sqlalchemy import DateTime, UniqueConstraint
+import os
+import time
+import threading
+import sqlalchemy, sqlalchemy.orm, sqlalchemy.pool
+from sqlalchemy import Date, DateTime, UniqueConstraint
 from geoalchemy2 import Geometry
 
 #-----------------------------------------------------------------------
 
+# connection pool settings, sized against the Postgres connection limit
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
 #-----------------------------------------------------------------------
 
 """
 Creates a SessionMaker object containing references to the database 
-schema. Implements the database schema if the tables do not already 
-exist.
+schema. The engine is created when the first session is opened, and 
+the schema is created and migrated by manage.py, not on import.
 """
 
 Base = sqlalchemy.orm.declarative_base()
@@ -48,6 +58,8 @@ class Cameras(Base):
     __tablename__ = 'cameras'
     __table_args__ = (
         UniqueConstraint('camera_id', 'date', name='uq_camera_id_date'),
+        # service-schedule queries
+        sqlalchemy.Index('ix_cameras_due_date', 'due_date'),
     )
     
     id = sqlalchemy.Column(sqlalchemy.Integer,
@@ -56,10 +68,16 @@ class Cameras(Base):
                               nullable=False)
     site = sqlalchemy.Column(sqlalchemy.String(30),
                                   nullable=False)
-    crds = sqlalchemy.Column(Geometry(geometry_type="POINT", srid=4326),
+    crds = sqlalchemy.Column(Geometry(geometry_type="POINT", srid=4326,
+                                      spatial_index=True),
                              nullable=False)
     status = sqlalchemy.Column(sqlalchemy.String(255),
                                nullable=False)
+    # parsed from "next,daysAhead" statuses; empty for free-text statuses
+    next_action = sqlalchemy.Column(sqlalchemy.String(30),
+                                    nullable=True)
+    due_date = sqlalchemy.Column(Date,
+                                 nullable=True)
     date = sqlalchemy.Column(DateTime(timezone=True), 
                              nullable=False)
     camera_id = sqlalchemy.Column(sqlalchemy.String(30),
@@ -73,6 +91,17 @@ class Cameras(Base):
     lock = sqlalchemy.Column(sqlalchemy.String(30))
     comments = sqlalchemy.Column(sqlalchemy.String(255),
                                  nullable=True)
+    created = sqlalchemy.Column(DateTime(timezone=True),
+                                server_default=sqlalchemy.func.now(),
+                                nullable=False)
+    updated = sqlalchemy.Column(DateTime(timezone=True),
+                                server_default=sqlalchemy.func.now(),
+                                onupdate=sqlalchemy.func.now(),
+                                nullable=False)
+
+# radius and nearest-neighbour searches measure distances on geography
+sqlalchemy.Index('ix_cameras_crds_geography', sqlalchemy.func.geography(Cameras.crds),
+                 postgresql_using='gist')
 
 #-----------------------------------
 
@@ -81,6 +110,9 @@ class Sightings(Base):
     __tablename__ = 'sightings'
     __table_args__ = (
         UniqueConstraint('observer', 'species', 'date', name='uq_sight_obs_spe_date'),
+        # time-range and per-species filters
+        sqlalchemy.Index('ix_sightings_date', 'date'),
+        sqlalchemy.Index('ix_sightings_species_date', 'species', 'date'),
     )
     
     id = sqlalchemy.Column(sqlalchemy.Integer,
@@ -91,7 +123,8 @@ class Sightings(Base):
                               nullable=False)
     observer = sqlalchemy.Column(sqlalchemy.String(30),
                                  nullable=False)
-    crds = sqlalchemy.Column(Geometry(geometry_type="POINT", srid=4326),
+    crds = sqlalchemy.Column(Geometry(geometry_type="POINT", srid=4326,
+                                      spatial_index=True),
                              nullable=False)
     date = sqlalchemy.Column(DateTime(timezone=True), 
                                     nullable=False)
@@ -103,8 +136,23 @@ class Sightings(Base):
                                 nullable=False)
     url = sqlalchemy.Column(sqlalchemy.String(255),
                             nullable=False)
+    # pending until the background upload of the image completes
+    image_status = sqlalchemy.Column(sqlalchemy.String(10),
+                                     nullable=False,
+                                     server_default='ready')
     comments = sqlalchemy.Column(sqlalchemy.String(255),
                                  nullable=True)
+    created = sqlalchemy.Column(DateTime(timezone=True),
+                                server_default=sqlalchemy.func.now(),
+                                nullable=False)
+    updated = sqlalchemy.Column(DateTime(timezone=True),
+                                server_default=sqlalchemy.func.now(),
+                                onupdate=sqlalchemy.func.now(),
+                                nullable=False)
+
+# radius and nearest-neighbour searches measure distances on geography
+sqlalchemy.Index('ix_sightings_crds_geography', sqlalchemy.func.geography(Sightings.crds),
+                 postgresql_using='gist')
 
 #-----------------------------------
 
@@ -120,9 +168,34 @@ class GeoAreas(Base):
                              nullable=False)
     description = sqlalchemy.Column(sqlalchemy.String(255),
                                     nullable=False)
-    geom = sqlalchemy.Column(Geometry('POLYGON', srid=4326), 
+    geom = sqlalchemy.Column(Geometry('POLYGON', srid=4326,
+                                      spatial_index=True), 
                              nullable=False)
-    
+    created = sqlalchemy.Column(DateTime(timezone=True),
+                                server_default=sqlalchemy.func.now(),
+                                nullable=False)
+    updated = sqlalchemy.Column(DateTime(timezone=True),
+                                server_default=sqlalchemy.func.now(),
+                                onupdate=sqlalchemy.func.now(),
+                                nullable=False)
+
+#-----------------------------------
+
+class GeoAreaLevels(Base):
+    __tablename__ = 'geoarea_levels'
+
+    # outlines simplified for display up to the given zoom level
+    id = sqlalchemy.Column(sqlalchemy.Integer,
+                           sqlalchemy.ForeignKey('geoareas.id'),
+                           primary_key=True,
+                           nullable=False)
+    level = sqlalchemy.Column(sqlalchemy.Integer,
+                              primary_key=True,
+                              nullable=False)
+    geom = sqlalchemy.Column(Geometry('GEOMETRY', srid=4326,
+                                      spatial_index=False),
+                             nullable=False)
+
 #-----------------------------------------------------------------------
 
 class Communities(Base):
@@ -138,6 +211,40 @@ class Communities(Base):
                              nullable=False)
     imageUrl = sqlalchemy.Column(sqlalchemy.String(255),
                                  nullable=False)
+    # pending until the background upload of the image completes
+    imageStatus = sqlalchemy.Column(sqlalchemy.String(10),
+                                    nullable=False,
+                                    server_default='ready')
+
+#-----------------------------------------------------------------------
+
+class UploadJobs(Base):
+    # image uploads waiting on the background uploader, kept across restarts
+    __tablename__ = 'upload_jobs'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer,
+                           primary_key=True)
+    kind = sqlalchemy.Column(sqlalchemy.String(30),
+                             nullable=False)
+    target = sqlalchemy.Column(sqlalchemy.String(30),
+                               nullable=False)
+    path = sqlalchemy.Column(sqlalchemy.String(255),
+                             nullable=False)
+    status = sqlalchemy.Column(sqlalchemy.String(10),
+                               nullable=False,
+                               server_default='pending',
+                               index=True)
+    attempts = sqlalchemy.Column(sqlalchemy.Integer,
+                                 nullable=False,
+                                 server_default='0')
+    error = sqlalchemy.Column(sqlalchemy.String(255),
+                              nullable=True)
+    # when a worker claimed the job by setting it running
+    claimed = sqlalchemy.Column(DateTime(timezone=True),
+                                nullable=True)
+    created = sqlalchemy.Column(DateTime(timezone=True),
+                                server_default=sqlalchemy.func.now(),
+                                nullable=False)
 
 #-----------------------------------------------------------------------
 
@@ -152,9 +259,32 @@ class UserCommunities(Base):
                              sqlalchemy.ForeignKey('communities.code'), 
                              primary_key=True,
                              nullable=False)
+    joined = sqlalchemy.Column(DateTime(timezone=True),
+                               server_default=sqlalchemy.func.now(),
+                               nullable=False)
+
+class CommunityDepartures(Base):
+    # records members leaving so clients can drop markers they lost
+    __tablename__ = 'community_departures'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer,
+                           primary_key=True)
+    uid = sqlalchemy.Column(sqlalchemy.String(30), 
+                            sqlalchemy.ForeignKey('users.uid'), 
+                            nullable=False)
+    code = sqlalchemy.Column(sqlalchemy.String(30), 
+                             sqlalchemy.ForeignKey('communities.code'), 
+                             nullable=False)
+    date = sqlalchemy.Column(DateTime(timezone=True),
+                             server_default=sqlalchemy.func.now(),
+                             nullable=False)
 
 class CameraCommunities(Base):
     __tablename__ = 'camera_communities'
+    __table_args__ = (
+        # visibility checks look markers up by community code
+        sqlalchemy.Index('ix_camera_communities_code', 'code', 'id'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, 
                            sqlalchemy.ForeignKey('cameras.id'), 
@@ -167,6 +297,10 @@ class CameraCommunities(Base):
 
 class SightingCommunities(Base):
     __tablename__ = 'sighting_communities'
+    __table_args__ = (
+        # visibility checks look markers up by community code
+        sqlalchemy.Index('ix_sighting_communities_code', 'code', 'id'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, 
                            sqlalchemy.ForeignKey('sightings.id'), 
@@ -179,6 +313,10 @@ class SightingCommunities(Base):
 
 class GeoAreaCommunities(Base):
     __tablename__ = 'geoarea_communities'
+    __table_args__ = (
+        # visibility checks look markers up by community code
+        sqlalchemy.Index('ix_geoarea_communities_code', 'code', 'id'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, 
                            sqlalchemy.ForeignKey('geoareas.id'), 
@@ -191,9 +329,120 @@ class GeoAreaCommunities(Base):
 
 #-----------------------------------------------------------------------
 
-_engine = sqlalchemy.create_engine(_DATABASE_URL)
+class GeoAreaCameras(Base):
+    # cameras inside each area, kept up to date when either is added
+    __tablename__ = 'geoarea_cameras'
+
+    area = sqlalchemy.Column(sqlalchemy.Integer,
+                             sqlalchemy.ForeignKey('geoareas.id'),
+                             primary_key=True,
+                             nullable=False)
+    id = sqlalchemy.Column(sqlalchemy.Integer,
+                           sqlalchemy.ForeignKey('cameras.id'),
+                           primary_key=True,
+                           nullable=False)
+
+class GeoAreaSightings(Base):
+    # sightings inside each area, kept up to date when either is added
+    __tablename__ = 'geoarea_sightings'
+
+    area = sqlalchemy.Column(sqlalchemy.Integer,
+                             sqlalchemy.ForeignKey('geoareas.id'),
+                             primary_key=True,
+                             nullable=False)
+    id = sqlalchemy.Column(sqlalchemy.Integer,
+                           sqlalchemy.ForeignKey('sightings.id'),
+                           primary_key=True,
+                           nullable=False)
+
+#-----------------------------------------------------------------------
+
+class PoolStats:
+    """Records how long connection checkouts wait on the pool."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            self.timeouts += timed_out
+
+    def stats(self, pool):
+        return {
+            "size": pool.size(),
+            "checkedOut": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "meanWaitSeconds": self.wait_seconds / self.checkouts if self.checkouts else 0.0,
+            "maxWaitSeconds": self.max_wait_seconds
+        }
+
+pool_stats = PoolStats()
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """QueuePool that records the wait time of each checkout."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_stats.record(time.perf_counter() - start, timed_out)
+
+#-----------------------------------------------------------------------
+
+class LazySessionmaker(sqlalchemy.orm.sessionmaker):
+    """sessionmaker that creates the engine when a session is first opened."""
+
+    def __call__(self, **local_kw):
+        get_engine()
+        return super().__call__(**local_kw)
+
+Session = LazySessionmaker()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Gets the engine, creating it and binding Session on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = sqlalchemy.create_engine(
+                    _DATABASE_URL,
+                    poolclass=TimedQueuePool,
+                    pool_size=POOL_SIZE,
+                    max_overflow=MAX_OVERFLOW,
+                    pool_timeout=POOL_TIMEOUT,
+                    pool_recycle=POOL_RECYCLE,
+                    pool_pre_ping=POOL_PRE_PING
+                )
+                Session.configure(bind=engine)
+                _engine = engine
+    return _engine
 
-# if the tables do not exist, create them
-Base.metadata.create_all(_engine)
+def get_pool_stats():
+    """Gets the connection pool usage and checkout wait times."""
+    return pool_stats.stats(get_engine().pool)
 
-Session = sqlalchemy.orm.sessionmaker(bind=_engine)
+def connect():
+    """
+    Opens a driver connection outside the pool, e.g. to LISTEN for
+    notifications for the life of the process.
+    """
+    connection = get_engine().raw_connection()
+    connection.detach()
+    return connection.driver_connection
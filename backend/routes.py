@@ -4,26 +4,143 @@
 
 #-----------------------------------------------------------------------
 # routes.py
-#-----------------------------------------------------------------------
-# Google Drive Configuration
-import io
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
-
 #-----------------------------------------------------------------------
 
 import json
-from flask import Blueprint, jsonify, request
+import time
+import hashlib
+from datetime import datetime, timedelta
+from dateutil import parser
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from shapely.geometry import shape
 from shapely.ops import unary_union
 from geoalchemy2.shape import from_shape
 import auth
+import cache
 import database
+import drive
+import events
+import imports
+import metrics
+import models
+import tokens
 
 #-----------------------------------------------------------------------
 # Constants
 ROLES = ['viewer', 'editor', 'admin']
+TILE_MAX_AGE = 300
+MAX_PAGE_SIZE = 5000
+MAX_SEARCH_RADIUS = 50000
+MAX_NEIGHBOURS = 100
+# seconds between rereads of an event stream's community codes
+CODES_REFRESH = 15
+
+#-----------------------------------------------------------------------
+
+def get_viewport(args):
+    """
+    Parses the optional viewport of a marker request. bbox is given as
+    "west,south,east,north" in degrees and zoom as a map zoom level.
+    """
+    bbox = args.get('bbox')
+    if bbox:
+        bbox = [float(x) for x in bbox.split(',')]
+        if len(bbox) != 4:
+            raise ValueError("bbox must be given as west,south,east,north.")
+    zoom = args.get('zoom', type=float)
+    return bbox or None, zoom
+
+def get_filters(args):
+    """
+    Parses the optional sighting filters of a request: start and end as
+    ISO datetimes, and species and observer as comma-separated lists.
+    """
+    filters = {}
+    for name in ('start', 'end'):
+        if args.get(name):
+            filters[name] = parser.isoparse(args.get(name))
+    for name in ('species', 'observer'):
+        if args.get(name):
+            filters[name] = [x.strip() for x in args.get(name).split(',')]
+    return filters or None
+
+def get_page(kind, reader, streamer):
+    """
+    Answers a paginated or streamed read of one marker kind. Pages are 
+    keyed by id: the response's next value is passed back as after to 
+    get the following page. With format=columnar, a page is returned
+    as parallel arrays of fields. With format=ndjson, all markers after
+    the cursor are streamed as newline-delimited JSON instead.
+    """
+    auth.verify_user(ROLES)
+    uid = request.form.get('uid')
+    bbox, _ = get_viewport(request.form)
+    after = request.form.get('after', type=int)
+    # only sightings can be filtered
+    extra = {"filters": get_filters(request.form)} if kind == "sightings" else {}
+
+    format = request.form.get('format')
+    if format == 'ndjson':
+        rows = (json.dumps(row) + '\n' for row in streamer(uid, bbox, after, **extra))
+        return Response(stream_with_context(rows), mimetype="application/x-ndjson")
+
+    limit = max(1, min(request.form.get('limit', MAX_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    columnar = format == 'columnar'
+    markers = reader(uid, bbox, after=after, limit=limit, columnar=columnar, **extra)
+    if isinstance(markers, dict) and "success" in markers:
+        return jsonify(markers)
+
+    ids = markers["id"] if columnar else [marker["id"] for marker in markers]
+    next_after = ids[-1] if len(ids) == limit else None
+    return jsonify({"success": True, kind: markers, "next": next_after})
+
+def get_search(args):
+    """
+    Parses the marker kind and origin of a search. The origin is given
+    either as lat and lon, or as origin_kind and origin_id naming a
+    marker, e.g. the sighting to find the nearest cameras to.
+    """
+    kind = args.get('kind')
+    if kind not in database.SEARCH_KINDS:
+        raise ValueError("kind must be cameras or sightings.")
+    if args.get('origin_kind'):
+        origin = (args.get('origin_kind'), args.get('origin_id', type=int))
+    else:
+        origin = (float(args['lat']), float(args['lon']))
+    return kind, origin
+
+def stream_events(uid, codes, cursor):
+    """
+    Yields Server-Sent Events for the markers added or changed in the
+    user's communities, starting with a ready event carrying a sync 
+    cursor so the client can catch up on anything it missed before 
+    subscribing. A resync event means events were dropped and the 
+    client should sync with /get-markers.
+    """
+    with events.broker.subscribe(codes) as subscription:
+        yield f"event: ready\ndata: {json.dumps({'cursor': cursor})}\n\n"
+        refreshed = time.monotonic()
+        while True:
+            # follow communities joined or left while connected, even when
+            # events keep the stream busy
+            if time.monotonic() - refreshed >= CODES_REFRESH:
+                subscription.codes = set(database.get_community_codes(uid))
+                refreshed = time.monotonic()
+            event = subscription.get(events.KEEPALIVE)
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            if event["type"] == "resync":
+                yield "event: resync\ndata: {}\n\n"
+                continue
+
+            shared = [code for code in event["communities"] if code in subscription.codes]
+            if not shared:
+                continue
+            data = {"action": event["action"],
+                    "marker": dict(event["marker"], communities=shared),
+                    "partial": event.get("partial", False)}
+            yield f"event: {event['type']}\ndata: {json.dumps(data)}\n\n"
 
 #-----------------------------------------------------------------------
 
@@ -31,19 +148,182 @@ main = Blueprint('main', __name__)
 
 @main.route("/get-markers", methods=["POST"])
 def get_cameras():
-    """Get all markers available to the current user."""
+    """
+    Get all markers available to the current user. If a since cursor is
+    given, only markers added, changed, or revoked after it are returned.
+    """
     try:
         auth.verify_user(ROLES)
         uid = request.form.get('uid')
-        cameras = database.get_cameras(uid)
-        sightings = database.get_sightings(uid)
-        areas = database.get_areas(uid)
-        
-        return jsonify({"success": True, 
-                        "message": "Markers successfully retrieved.", 
-                        "cameras": cameras,
-                        "sightings": sightings,
-                        "areas": areas})
+        bbox, zoom = get_viewport(request.form)
+        filters = get_filters(request.form)
+        since = request.form.get('since')
+
+        # unchanged marker data is answered without running the reads
+        version = database.get_marker_version(uid)
+        etag = hashlib.sha1(
+            repr((version, bbox, zoom, since, request.form.get('format'), filters)).encode()
+        ).hexdigest()
+        if etag in request.if_none_match:
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+        since = parser.isoparse(since) if since else None
+        columnar = request.form.get('format') == 'columnar'
+        markers = database.get_markers(uid, bbox, zoom, since, columnar, filters)
+        # failed reads must not be tagged, or the client keeps the error
+        # behind 304s until the markers change
+        for value in markers.values():
+            if isinstance(value, dict) and value.get("success") is False:
+                return jsonify({"success": False, "message": value["message"]})
+
+        body = {"success": True, 
+                "message": "Markers successfully retrieved.", 
+                "cameras": markers["cameras"],
+                "sightings": markers["sightings"],
+                "areas": markers["areas"],
+                "cursor": markers["cursor"]}
+        if since:
+            body["revoked"] = database.get_revoked(uid, since)
+
+        response = jsonify(body)
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/events", methods=["GET"])
+def get_events():
+    """Stream new and changed markers as Server-Sent Events."""
+    try:
+        auth.verify_user(ROLES)
+        uid = request.args.get('uid')
+        codes, cursor = database.get_synced_codes(uid)
+        # not stream_with_context: the stream must not hold the request's
+        # database session open while it waits for events
+        response = Response(stream_events(uid, codes, cursor),
+                            mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/pool-stats", methods=["GET"])
+def get_pool_stats():
+    """Get the connection pool usage and checkout wait times."""
+    try:
+        auth.verify_user(ROLES[2:])
+        return jsonify({"success": True, "pool": models.get_pool_stats()})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/get-cameras", methods=["POST"])
+def get_camera_page():
+    """Get a page or stream of the cameras available to the current user."""
+    try:
+        return get_page("cameras", database.get_cameras, database.iter_cameras)
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/get-sightings", methods=["POST"])
+def get_sighting_page():
+    """Get a page or stream of the sightings available to the current user."""
+    try:
+        return get_page("sightings", database.get_sightings, database.iter_sightings)
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/analytics/activity", methods=["POST"])
+def get_activity():
+    """Get species activity by hour and weekday for an area or community."""
+    try:
+        auth.verify_user(ROLES)
+        uid = request.form.get('uid')
+        area = request.form.get('area', type=int)
+        community = request.form.get('community')
+        filters = get_filters(request.form)
+        activity = database.get_activity(uid, area, community, filters)
+        if "success" in activity:
+            return jsonify(activity)
+        return jsonify({"success": True, "activity": activity})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/search/radius", methods=["POST"])
+def search_radius():
+    """Get the markers of one kind within a radius in meters, nearest first."""
+    try:
+        auth.verify_user(ROLES)
+        uid = request.form.get('uid')
+        kind, origin = get_search(request.form)
+        meters = request.form.get('radius', type=float)
+        if meters is None or meters <= 0:
+            raise ValueError("radius must be a positive number of meters.")
+        meters = min(meters, MAX_SEARCH_RADIUS)
+        limit = max(1, min(request.form.get('limit', MAX_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        markers = database.search_radius(uid, kind, origin, meters, limit,
+                                         get_filters(request.form))
+        if isinstance(markers, dict):
+            return jsonify(markers)
+        return jsonify({"success": True, kind: markers})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/search/nearest", methods=["POST"])
+def search_nearest():
+    """Get the k markers of one kind nearest to a point or marker."""
+    try:
+        auth.verify_user(ROLES)
+        uid = request.form.get('uid')
+        kind, origin = get_search(request.form)
+        k = max(1, min(request.form.get('k', 1, type=int), MAX_NEIGHBOURS))
+        markers = database.search_nearest(uid, kind, origin, k,
+                                          get_filters(request.form))
+        if isinstance(markers, dict):
+            return jsonify(markers)
+        return jsonify({"success": True, kind: markers})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Get the hit and miss counters of the marker cache."""
+    try:
+        auth.verify_user(ROLES[2:])
+        return jsonify({"success": True, "cache": cache.markers.stats()})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Get request, SQL, cache, pool, and token metrics for Prometheus."""
+    try:
+        auth.verify_user(ROLES[2:])
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@main.route("/tiles/<layer>/<int:z>/<int:x>/<int:y>.mvt", methods=["GET"])
+def get_tile(layer, z, x, y):
+    """Get a vector tile of the markers available to the current user."""
+    try:
+        auth.verify_user(ROLES)
+        if layer not in database.TILE_LAYERS:
+            return jsonify({"success": False, "message": f"Unknown layer {layer}."}), 404
+
+        uid = request.args.get('uid')
+        codes = database.get_community_codes(uid)
+        tile = database.get_tile(layer, z, x, y, codes)
+        if isinstance(tile, dict):
+            return jsonify(tile)
+
+        # tiles depend only on the community set, so they are tagged by it
+        community_set = hashlib.sha1(','.join(codes).encode()).hexdigest()[:16]
+        response = Response(tile, mimetype="application/vnd.mapbox-vector-tile")
+        response.set_etag(f"{community_set}-{hashlib.sha1(tile).hexdigest()}")
+        response.cache_control.private = True
+        response.cache_control.max_age = TILE_MAX_AGE
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({"success": False, "message": str(e)})
 
@@ -61,6 +341,20 @@ def add_marker():
         print(str(e))
         return jsonify({"success": False, "message": str(e)})
 
+@main.route("/import-cameras", methods=["POST"])
+def import_cameras():
+    """Add many camera markers from an uploaded CSV or GeoJSON file."""
+    try:
+        auth.verify_user(ROLES[1:])
+        uid = request.form.get('uid')
+        communities = request.form.get('communities').split(',')
+        rows = imports.read_cameras(request.files['file'])
+        response = database.add_cameras(uid, rows, communities)
+        return jsonify(response)
+    except Exception as e:
+        print(str(e))
+        return jsonify({"success": False, "message": str(e)})
+
 @main.route('/update-camera-status/<camera_id>', methods=['POST'])
 def update_camera_status(camera_id):
     try:
@@ -71,23 +365,47 @@ def update_camera_status(camera_id):
     except Exception as e:
         return jsonify({"success": False, "message": str(e)})
 
+@main.route('/update-camera-statuses', methods=['POST'])
+def update_camera_statuses():
+    """Update the statuses of many cameras at once."""
+    try:
+        auth.verify_user(ROLES[1:])
+        data = request.get_json()
+        response = database.update_statuses(data.get("uid"), data.get("updates", []))
+        return jsonify(response)
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
+@main.route('/cameras/due', methods=['POST'])
+def get_due_cameras():
+    """Get the cameras due for servicing, by default within a week."""
+    try:
+        auth.verify_user(ROLES)
+        uid = request.form.get('uid')
+        before = request.form.get('before')
+        # due dates are local dates, not the server's
+        today = datetime.now(database.LOCAL_TIMEZONE).date()
+        before = parser.isoparse(before).date() if before else today + timedelta(days=7)
+        cameras = database.get_due_cameras(uid, before, request.form.get('next'))
+        if isinstance(cameras, dict):
+            return jsonify(cameras)
+        return jsonify({"success": True, "cameras": cameras})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
 @main.route("/upload-photo", methods=["POST"])
 def upload_photo():
     try:
         auth.verify_user(ROLES[1:])
         files = request.files.getlist('files')
-        
-        for file in files:
-            file_stream = io.BytesIO(file.read())
-            media = MediaIoBaseUpload(file_stream, mimetype=file.mimetype)
-            file_metadata = {'name': file.filename, 'parents': [UPLOAD_FOLDER_ID]}
-            drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
+        results = drive.upload_files(files)
 
-        return jsonify({"success": True, 'message': "Upload successful."})
+        failed = [result for result in results if not result["success"]]
+        if failed:
+            return jsonify({"success": False, 
+                            "message": f"{len(failed)} of {len(results)} uploads failed.",
+                            "files": results})
+        return jsonify({"success": True, 'message': "Upload successful.", "files": results})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)})
     
@@ -104,6 +422,19 @@ def add_sighting():
         print(str(e))
         return jsonify({"success": False, "message": str(e)})
 
+@main.route("/add-sightings", methods=["POST"])
+def add_sightings():
+    """Add the sightings in a batch of camera-trap images to the map."""
+    try:
+        auth.verify_user(ROLES[1:])
+        data = request.form.to_dict()
+        images = request.files.getlist('images')
+        response = database.add_sightings(data, images)
+        return jsonify(response)
+    except Exception as e:
+        print(str(e))
+        return jsonify({"success": False, "message": str(e)})
+
 @main.route("/add-area", methods=["POST"])
 def add_area():
     """Add a user-defined area to the map."""
@@ -140,6 +471,15 @@ def add_user():
         print(f"A fatal exception occurred while adding the user: {str(e)}")
         return jsonify({"success": False, "message": str(e)})
         
+@auth_bp.route('/auth-stats', methods=['GET'])
+def get_auth_stats():
+    """Get the token cache hit ratio and verification latency."""
+    try:
+        auth.verify_user(ROLES[2:])
+        return jsonify({"success": True, "tokens": tokens.verifier.stats()})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
 @auth_bp.route('/set-role', methods=['POST'])
 def set_role():
     auth.verify_user(ROLES[2:])
@@ -187,6 +527,16 @@ def add_community():
         print(str(e))
         return jsonify({"success": False, "message": str(e)})
 
+@community.route('/leave-community/<community_code>', methods=['POST'])
+def leave_community(community_code):
+    try:
+        auth.verify_user(ROLES)
+        uid = request.form.get('uid')
+        response = database.leave_community(uid, community_code)
+        return jsonify(response)
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)})
+
 @community.route('/join-community/<community_code>', methods=['POST'])
 def join_community(community_code):
     try:
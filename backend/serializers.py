@@ -0,0 +1,57 @@
+"""
+Serializes marker rows selected as plain tuples. Coordinates are
+extracted by the database with ST_Y/ST_X instead of decoding each
+geometry in Python.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# serializers.py
+#-----------------------------------------------------------------------
+
+from datetime import date
+from geoalchemy2.functions import ST_X, ST_Y
+
+#-----------------------------------------------------------------------
+
+def columns(model):
+    """
+    Gets the columns to select for model, with the crds point split
+    into lat and lon.
+    """
+    selected = []
+    for c in model.__table__.columns:
+        if c.name == "crds":
+            selected += [ST_Y(c).label("lat"), ST_X(c).label("lon")]
+        else:
+            selected.append(c)
+    return selected
+
+def _value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+def to_dict(row):
+    """
+    Serializes a row selected with columns() in the same format as
+    database.to_dict, with crds given as a "lat, lon" string.
+    """
+    result = {}
+    for name, value in row._mapping.items():
+        if name == "lat":
+            result["crds"] = f"{value}, {row.lon}"
+        elif name != "lon":
+            result[name] = _value(value)
+    return result
+
+def to_columnar(rows, keys):
+    """
+    Serializes rows selected with columns() as parallel arrays, one per
+    column in keys, e.g. {"id": [...], "lat": [...], "lon": [...]}.
+    """
+    result = {key: [] for key in keys}
+    arrays = [result[key] for key in keys]
+    for row in rows:
+        for array, value in zip(arrays, row):
+            array.append(_value(value))
+    return result
@@ -0,0 +1,161 @@
+"""
+Verifies Firebase ID tokens locally. Verified tokens are cached by hash
+until they expire, and Google's signing certificates are cached and
+refreshed in the background, so repeated requests from one session skip
+both signature verification and key fetches. The HTTP and JWT
+libraries are only imported on first use, to keep worker startup fast.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# tokens.py
+#-----------------------------------------------------------------------
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+#-----------------------------------------------------------------------
+
+CERTS_URL = ('https://www.googleapis.com/robot/v1/metadata/x509/'
+             'securetoken@system.gserviceaccount.com')
+PROJECT_ID = os.environ.get('FIREBASE_PROJECT_ID')
+KEY_REFRESH = 3600
+# unknown key ids trigger a refetch at most this often
+MIN_KEY_AGE = 60
+MAX_TOKENS = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
+#-----------------------------------------------------------------------
+
+class KeySet:
+    """
+    Signing certificates by key id. Certificates are fetched from url,
+    or given directly as keys, e.g. a local signing key in tests.
+    """
+
+    def __init__(self, url=CERTS_URL, keys=None, refresh=KEY_REFRESH):
+        self.url = url
+        self.keys = keys
+        self.refresh = refresh
+        self.fetches = 0
+        self.fetched_at = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def get(self):
+        if self.keys is None:
+            with self._lock:
+                if self.keys is None:
+                    self.fetch()
+        if self.url and self._refresher is None:
+            self._start()
+        return self.keys
+
+    def fetch(self, min_age=0):
+        if self.fetched_at and time.monotonic() - self.fetched_at < min_age:
+            return
+        import requests
+        response = requests.get(self.url, timeout=10)
+        response.raise_for_status()
+        self.keys = response.json()
+        self.fetched_at = time.monotonic()
+        self.fetches += 1
+
+    def _start(self):
+        def refresh():
+            while True:
+                time.sleep(self.refresh)
+                try:
+                    self.fetch()
+                except Exception as e:
+                    print(f'Failed to refresh signing keys: {str(e)}')
+
+        self._refresher = threading.Thread(target=refresh, daemon=True)
+        self._refresher.start()
+
+#-----------------------------------------------------------------------
+
+class TokenVerifier:
+    """Verifies ID tokens against a KeySet, caching verified claims."""
+
+    def __init__(self, keys, project_id=PROJECT_ID, maxsize=MAX_TOKENS):
+        self.keys = keys
+        self.project_id = project_id
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.verify_seconds = 0.0
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, key):
+        with self._lock:
+            claims = self._tokens.get(key)
+            if claims is None or claims['exp'] <= time.time():
+                self._tokens.pop(key, None)
+                self.misses += 1
+                return None
+            self._tokens.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def verify(self, token):
+        """Gets the claims of token, raising ValueError if it is invalid."""
+        key = hashlib.sha256(token.encode()).hexdigest()
+        claims = self._cached(key)
+        if claims is not None:
+            return claims
+
+        from google.auth import jwt
+        start = time.perf_counter()
+        try:
+            keys = self.keys.get()
+            # the key set may have rotated since it was last fetched
+            if jwt.decode_header(token).get('kid') not in keys and self.keys.url:
+                self.keys.fetch(MIN_KEY_AGE)
+                keys = self.keys.get()
+            claims = jwt.decode(token, certs=keys, audience=self.project_id)
+        finally:
+            with self._lock:
+                self.verify_seconds += time.perf_counter() - start
+
+        issuer = f'https://securetoken.google.com/{self.project_id}'
+        if claims.get('iss') != issuer or not claims.get('sub'):
+            raise ValueError('Token has an invalid issuer or subject.')
+        claims['uid'] = claims['sub']
+
+        # cached claims are only used until the token itself expires
+        with self._lock:
+            self._tokens[key] = claims
+            while len(self._tokens) > self.maxsize:
+                self._tokens.popitem(last=False)
+        return claims
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / total if total else 0.0,
+            "meanVerifySeconds": self.verify_seconds / self.misses if self.misses else 0.0,
+            "keyFetches": self.keys.fetches
+        }
+
+#-----------------------------------------------------------------------
+
+verifier = TokenVerifier(KeySet())
+
+def verify_id_token(token):
+    """
+    Verifies a Firebase ID token, as firebase_admin.auth.verify_id_token
+    does, and returns its claims.
+    """
+    return verifier.verify(token)
+
+def set_verifier(new_verifier):
+    """Replaces the verifier, e.g. with one using a local signing key."""
+    global verifier
+    verifier = new_verifier
@@ -0,0 +1,184 @@
+"""
+Uploads sighting and community images in the background. Images are
+spooled to disk and recorded in the upload_jobs table, so pending
+uploads survive restarts as long as UPLOAD_SPOOL_DIR is on persistent
+storage, then handed to a thread pool that fills in the image URL once
+the upload completes. Workers claim a job before uploading it, so no
+image is uploaded twice by workers resuming the same jobs.
+"""
+
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------
+# uploads.py
+#-----------------------------------------------------------------------
+
+import os
+import uuid
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import update, or_, and_, func
+from models import Session, UploadJobs, Sightings, Communities
+from models import SightingCommunities
+import cache
+
+#-----------------------------------------------------------------------
+
+SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR',
+                           os.path.join(tempfile.gettempdir(), 'afc-uploads'))
+MAX_ATTEMPTS = int(os.environ.get('UPLOAD_MAX_ATTEMPTS', 5))
+RETRY_DELAY = 5
+# running jobs claimed longer ago than this are taken to be abandoned by
+# a worker that died mid-upload
+CLAIM_TIMEOUT = timedelta(seconds=int(os.environ.get('UPLOAD_CLAIM_TIMEOUT', 600)))
+
+if 'UPLOAD_SPOOL_DIR' not in os.environ:
+    print(f'UPLOAD_SPOOL_DIR is not set; spooled images in {SPOOL_DIR} '
+          'will not survive a container restart.')
+
+#-----------------------------------------------------------------------
+
+class CloudinaryUploader:
+    """Uploads images to Cloudinary."""
+
+    def upload(self, path):
+        import cloudinary.uploader
+        return cloudinary.uploader.upload(path).get("secure_url")
+
+class LocalUploader:
+    """Copies images into a local directory, e.g. for tests."""
+
+    def __init__(self, directory, base_url='file://'):
+        self.directory = directory
+        self.base_url = base_url
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, path):
+        name = os.path.basename(path)
+        shutil.copy(path, os.path.join(self.directory, name))
+        return self.base_url + name
+
+_uploader = CloudinaryUploader()
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('UPLOAD_WORKERS', 4)),
+    thread_name_prefix='upload'
+)
+
+def set_uploader(uploader):
+    """Replaces the uploader used by the background workers."""
+    global _uploader
+    _uploader = uploader
+
+#-----------------------------------------------------------------------
+
+def spool(image):
+    """Saves an uploaded image to the spool directory."""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    _, ext = os.path.splitext(image.filename or '')
+    path = os.path.join(SPOOL_DIR, uuid.uuid4().hex + ext)
+    image.save(path)
+    return path
+
+def enqueue(session, kind, target, image):
+    """
+    Spools image to disk and adds an upload job for it to session. The
+    job runs once submit is called with its id after the commit.
+    """
+    path = spool(image)
+    job = UploadJobs(kind=kind, target=str(target), path=path)
+    session.add(job)
+    session.flush()
+    return job.id
+
+def submit(job_id, delay=0):
+    """Runs the upload job with the given id on the worker pool."""
+    if delay:
+        timer = threading.Timer(delay, submit, [job_id])
+        timer.daemon = True
+        timer.start()
+    else:
+        _executor.submit(_run, job_id)
+
+def _claimable():
+    """True for jobs waiting to run or abandoned while running."""
+    return or_(
+        UploadJobs.status == 'pending',
+        and_(UploadJobs.status == 'running',
+             UploadJobs.claimed < func.now() - CLAIM_TIMEOUT)
+    )
+
+def resume():
+    """
+    Resubmits all jobs left pending or abandoned, e.g. by a restart. Jobs
+    another worker is running are skipped when they are claimed.
+    """
+    with Session() as session:
+        pending = session.query(UploadJobs.id).filter(_claimable()).all()
+    for job_id, in pending:
+        submit(job_id)
+    return len(pending)
+
+#-----------------------------------------------------------------------
+
+def _set_image(session, job, url, status):
+    """Fills in the image of the row the job was created for."""
+    if job.kind == 'sighting':
+        sighting = session.get(Sightings, int(job.target))
+        if sighting:
+            sighting.url = url or sighting.url
+            sighting.image_status = status
+        codes = session.query(SightingCommunities.code).filter(
+            SightingCommunities.id == int(job.target)
+        ).all()
+        return [code for code, in codes]
+
+    community = session.get(Communities, job.target)
+    if community:
+        community.imageUrl = url or community.imageUrl
+        community.imageStatus = status
+    return []
+
+def _run(job_id):
+    """Uploads the image of a job, retrying with backoff on failure."""
+    # claim the job atomically; no connection is held while the upload
+    # is in flight
+    with Session() as session:
+        path = session.execute(
+            update(UploadJobs).where(
+                UploadJobs.id == job_id, _claimable()
+            ).values(status='running', claimed=func.now()).returning(UploadJobs.path)
+        ).scalar()
+        session.commit()
+    if path is None:
+        return
+
+    try:
+        url, error = _uploader.upload(path), None
+    except Exception as e:
+        print(f'Upload {job_id} failed: {str(e)}')
+        url, error = None, str(e)
+
+    with Session() as session:
+        job = session.get(UploadJobs, job_id)
+        if error:
+            job.attempts += 1
+            job.error = error[:255]
+            if job.attempts < MAX_ATTEMPTS:
+                delay = RETRY_DELAY * 2 ** (job.attempts - 1)
+                job.status = 'pending'
+                session.commit()
+                submit(job_id, delay)
+                return
+            job.status = 'failed'
+            codes = _set_image(session, job, None, 'failed')
+        else:
+            job.status = 'done'
+            codes = _set_image(session, job, url, 'ready')
+        session.commit()
+    cache.markers.invalidate(codes)
+
+    if url and os.path.exists(path):
+        os.remove(path)